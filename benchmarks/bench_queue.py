@@ -0,0 +1,69 @@
+"""Compare the event-driven AsyncQueue against the old polling queue.
+
+Measures the enqueue→dequeue latency of items put from a thread and consumed
+in an event loop, and the CPU time used by an idle consumer.
+
+Usage: python benchmarks/bench_queue.py [MESSAGES] [IDLE_SECONDS]
+"""
+
+import asyncio
+import queue
+import statistics
+import sys
+import threading
+import time
+
+from simplebot_tggroups.util import AsyncQueue
+
+
+class PollingQueue(queue.Queue):
+    """The queue used before, it polls every 20ms."""
+
+    async def aget(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                await asyncio.sleep(0.02)
+
+
+async def _latency(q, count: int) -> list:
+    def produce() -> None:
+        for _ in range(count):
+            q.put(time.perf_counter())
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    latencies = []
+    for _ in range(count):
+        sent = await q.aget()
+        latencies.append(time.perf_counter() - sent)
+    thread.join()
+    return latencies
+
+
+async def _idle_cpu(q, seconds: float) -> float:
+    task = asyncio.ensure_future(q.aget())
+    start = time.process_time()
+    await asyncio.sleep(seconds)
+    used = time.process_time() - start
+    task.cancel()
+    return used
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    idle = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    for name, factory in (("polling", PollingQueue), ("event-driven", AsyncQueue)):
+        latencies = sorted(asyncio.run(_latency(factory(), count)))
+        cpu = asyncio.run(_idle_cpu(factory(), idle))
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(
+            f"{name:>12}: latency p50={statistics.median(latencies) * 1000:.3f}ms"
+            f" p99={p99 * 1000:.3f}ms, idle CPU={cpu * 1000:.1f}ms in {idle}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
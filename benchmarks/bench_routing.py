@@ -0,0 +1,51 @@
+"""Measure bridge lookups per second, in-memory routing table vs SQLite query.
+
+Usage: python benchmarks/bench_routing.py [LINKS] [LOOKUPS]
+"""
+
+import os
+import random
+import sys
+import time
+from tempfile import TemporaryDirectory
+
+from simplebot_tggroups.orm import Link, init, session_scope
+from simplebot_tggroups.routing import routes
+
+
+def main() -> None:
+    links = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with TemporaryDirectory() as tempdir:
+        init(f"sqlite:///{os.path.join(tempdir, 'sqlite.db')}")
+        with session_scope() as session:
+            for dcchat in range(links):
+                session.add(Link(dcchat=dcchat, tgchat=-dcchat - 1))
+        init(f"sqlite:///{os.path.join(tempdir, 'sqlite.db')}")  # reload routes
+        keys = [random.randrange(links) for _ in range(lookups)]
+
+        start = time.perf_counter()
+        for dcchat in keys:
+            with session_scope() as session:
+                _ = [
+                    link.tgchat for link in session.query(Link).filter_by(dcchat=dcchat)
+                ]
+                _ = [
+                    link.dcchat
+                    for link in session.query(Link).filter_by(tgchat=-dcchat - 1)
+                ]
+        database = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for dcchat in keys:
+            routes.get_tgchats(dcchat)
+            routes.get_dcchats(-dcchat - 1)
+        memory = time.perf_counter() - start
+
+    print(f"{links} links, {lookups * 2} lookups")
+    print(f"  database: {lookups * 2 / database:,.0f} lookups/s")
+    print(f"    memory: {lookups * 2 / memory:,.0f} lookups/s")
+
+
+if __name__ == "__main__":
+    main()
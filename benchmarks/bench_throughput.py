@@ -0,0 +1,177 @@
+"""Offline end-to-end throughput benchmark of the bridge.
+
+Drives TelegramBot.tg2dc, TelegramBot.dc2tg and filter_messages with a fake
+Telegram client and simplebot's mocker, and reports throughput, relay
+latency percentiles and peak RSS.
+
+Usage: pytest -s benchmarks/bench_throughput.py
+
+Parameters are set with environment variables:
+
+- BENCH_GROUPS: number of bridged groups (default: 20)
+- BENCH_RATE: messages per second in each direction (default: 200)
+- BENCH_SECONDS: duration of the load (default: 5)
+- BENCH_MEDIA: mix of attachment sizes as size:ratio pairs (default: 0:0.8,65536:0.15,1048576:0.05)
+- BENCH_SEND_LATENCY: simulated Telegram latency in seconds (default: 0.05)
+"""
+
+import asyncio
+import itertools
+import os
+import random
+import resource
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+from simplebot_tggroups import filter_messages
+from simplebot_tggroups.orm import links
+from simplebot_tggroups.tgbot import TelegramBot
+from simplebot_tggroups.util import set_config
+
+GROUPS = int(os.getenv("BENCH_GROUPS", "20"))
+RATE = float(os.getenv("BENCH_RATE", "200"))
+SECONDS = float(os.getenv("BENCH_SECONDS", "5"))
+MEDIA = [
+    (int(size), float(ratio))
+    for size, ratio in (
+        pair.split(":")
+        for pair in os.getenv("BENCH_MEDIA", "0:0.8,65536:0.15,1048576:0.05").split(",")
+    )
+]
+SEND_LATENCY = float(os.getenv("BENCH_SEND_LATENCY", "0.05"))
+
+
+class FakeTelegramBot(TelegramBot):  # noqa
+    """TelegramBot that never connects to Telegram."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.ids = itertools.count(1)
+        self.sent: Dict[int, float] = {}  # Delta Chat message ID -> time relayed
+        self.received: Dict[int, float] = {}  # Telegram message ID -> time relayed
+
+    async def send_message(self, entity, message="", **kwargs):  # noqa
+        await asyncio.sleep(SEND_LATENCY)
+        return SimpleNamespace(id=next(self.ids))
+
+    async def _dc2tg(self, tgchat, item) -> None:
+        await super()._dc2tg(tgchat, item)
+        self.sent[item[1]] = time.perf_counter()
+
+    def _send_to_dc(self, tgchat, items, files=None) -> dict:
+        copies = super()._send_to_dc(tgchat, items, files)
+        now = time.perf_counter()
+        for tgmsg_id, _, _ in items:
+            self.received[tgmsg_id] = now
+        return copies
+
+
+class FakeTelegramMessage(SimpleNamespace):  # noqa
+    async def download_media(self, folder: str) -> str:
+        await asyncio.sleep(SEND_LATENCY + self.file.size / 50_000_000)
+        path = os.path.join(folder, self.file.name)
+        with open(path, "wb") as file:
+            file.write(os.urandom(self.file.size))
+        return path
+
+
+def _media_size() -> int:
+    sizes, ratios = zip(*MEDIA)
+    return random.choices(sizes, ratios)[0]
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] * 1000
+
+
+def test_throughput(mocker) -> None:
+    bot = mocker.bot
+    for key, value in dict(  # noqa
+        api_id="1", api_hash="0" * 32, global_rate="1000000", chat_rate="1000000"
+    ).items():
+        set_config(bot, key, value)
+
+    chats = []
+    for index in range(GROUPS):
+        chat = mocker.account.create_group_chat(f"group {index}")
+        chats.append((chat, -1000 - index))
+        links.add(chat.id, -1000 - index)
+
+    files = {}
+    for size, _ in MEDIA:
+        if size:
+            # attachments of outgoing messages must be in the blob folder
+            files[size] = os.path.join(mocker.account.get_blobdir(), f"{size}.bin")
+            with open(files[size], "wb") as file:
+                file.write(os.urandom(size))
+    dc_count = tg_count = int(RATE * SECONDS)
+    dc_queued: Dict[int, float] = {}
+    tg_queued: Dict[int, float] = {}
+
+    def produce_dc() -> None:
+        for index in range(dc_count):
+            chat, _ = random.choice(chats)
+            size = _media_size()
+            msg = mocker.make_incoming_message(
+                text=f"message {index}", filename=files.get(size), group=chat
+            )
+            dc_queued[msg.id] = time.perf_counter()
+            filter_messages(bot, msg)
+            time.sleep(1 / RATE)
+
+    async def produce_tg(tgbot: FakeTelegramBot) -> None:
+        sender = SimpleNamespace(first_name="Bob", last_name=None)
+        for msgid in range(1, tg_count + 1):
+            _, tgchat = random.choice(chats)
+            size = _media_size()
+            tgmsg = FakeTelegramMessage(
+                id=msgid,
+                text=f"message {msgid}",
+                sender=sender,
+                sender_id=1,
+                file=size and SimpleNamespace(size=size, name=f"{msgid}.bin"),
+                sticker=None,
+                photo=None,
+                document=None,
+                grouped_id=None,
+                reply_to=None,
+            )
+            tg_queued[msgid] = time.perf_counter()
+            await tgbot.tg2dc(SimpleNamespace(message=tgmsg, chat_id=tgchat))
+            await asyncio.sleep(1 / RATE)
+
+    async def run() -> tuple:
+        tgbot = FakeTelegramBot(bot)
+        consumer = asyncio.ensure_future(tgbot.dc2tg())
+        start = time.perf_counter()
+        producer = threading.Thread(target=produce_dc)
+        producer.start()
+        await produce_tg(tgbot)
+        producer.join()
+        deadline = time.perf_counter() + SECONDS * 10 + 30
+        while len(tgbot.sent) < dc_count or len(tgbot.received) < tg_count:
+            assert time.perf_counter() < deadline, "timed out waiting for messages"
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        consumer.cancel()
+        return elapsed, tgbot
+
+    elapsed, tgbot = asyncio.run(run())
+    dc_latency = [tgbot.sent[msgid] - queued for msgid, queued in dc_queued.items()]
+    tg_latency = [tgbot.received[msgid] - queued for msgid, queued in tg_queued.items()]
+    print(
+        f"\n{GROUPS} groups, {RATE:g} msg/s per direction for {SECONDS:g}s,"
+        f" media mix: {MEDIA}"
+    )
+    for name, latency in (("dc2tg", dc_latency), ("tg2dc", tg_latency)):
+        print(
+            f"{name}: {len(latency) / elapsed:.1f} msg/s,"
+            f" latency p50={_percentile(latency, 50):.1f}ms"
+            f" p99={_percentile(latency, 99):.1f}ms"
+        )
+    print(
+        f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB"
+    )
@@ -3,213 +3,34 @@
 import asyncio
 import logging
 import os
-from tempfile import NamedTemporaryFile, TemporaryDirectory
 from threading import Thread
-from typing import Any
 
 import simplebot
-from cachelib import FileSystemCache
 from deltachat import Chat, Contact, Message
-from pydub import AudioSegment
 from simplebot import DeltaBot
 from simplebot.bot import Replies
-from telethon import TelegramClient, events, functions, types
-from telethon.errors.rpcerrorlist import ChannelPrivateError, ChatIdInvalidError
 
-from .orm import Link, init, session_scope
+from .dcside import ContactsListener
+from .metrics import DB_TIME, start_file_dump, start_http_server
+from .outbox import outbox
+from .routing import routes
 from .subcommands import telegram
-from .util import AsyncQueue, get_session_path, getdefault, shorten_text, sync
+from .util import MediaLimits, get_media_limits, getdefault, set_config, sync
 
 logging.basicConfig(
     format="[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s", level=logging.WARNING
 )
+# Telegram sides running in this process, their state is saved on shutdown
+_tgbots: list = []
 
-msgs_queue: AsyncQueue = AsyncQueue()
 
+def __getattr__(name: str):
+    # the Telegram side is imported on first use, to start faster
+    if name == "TelegramBot":
+        from .tgbot import TelegramBot  # noqa
 
-class TelegramBot(TelegramClient):  # noqa
-    def __init__(self, dcbot: DeltaBot) -> None:
-        super().__init__(
-            get_session_path(dcbot),
-            api_id=getdefault(dcbot, "api_id"),
-            api_hash=getdefault(dcbot, "api_hash"),
-        )
-        self.dcbot = dcbot
-
-        plugin_dir = os.path.join(os.path.dirname(self.dcbot.account.db_path), __name__)
-        if not os.path.exists(plugin_dir):
-            os.makedirs(plugin_dir)
-        cache_dir = os.path.join(plugin_dir, "cache")
-        self.cache = FileSystemCache(
-            cache_dir, threshold=0, default_timeout=60 * 60 * 24 * 60
-        )
-
-        self.add_event_handler(
-            self.start_cmd, events.NewMessage(pattern="/start", incoming=True)
-        )
-        self.add_event_handler(
-            self.id_cmd, events.NewMessage(pattern="/id", incoming=True)
-        )
-        self.add_event_handler(self.tg2dc, events.NewMessage(incoming=True))
-
-    async def set_commands(self) -> None:
-        await self(
-            functions.bots.SetBotCommandsRequest(
-                scope=types.BotCommandScopeDefault(),
-                lang_code="en",
-                commands=[
-                    types.BotCommand(
-                        command="id", description="gets the ID of the current chat"
-                    )
-                ],
-            )
-        )
-        self.dcbot.logger.debug("Registered commands on Telegram")
-
-    def _acc2mp3(self, filename: str) -> Any:
-        try:
-            file_ = NamedTemporaryFile(suffix=".mp3")  # noqa
-            audio = AudioSegment.from_file(filename, "aac")
-            audio.export(file_.name, format="mp3")
-            return file_
-        except Exception as err:
-            self.dcbot.logger.exception(err)
-            return filename
-
-    async def start_cmd(self, event: events.NewMessage) -> None:
-        await event.reply(
-            "This is a Delta Chat bridge relaybot and does not support direct chats"
-        )
-        raise events.StopPropagation
-
-    async def id_cmd(self, event: events.NewMessage) -> None:
-        if event.is_private:
-            text = "❌ You must send that command in a Telegram group, not here"
-        else:
-            text = str(event.chat_id)
-        await event.reply(text)
-        raise events.StopPropagation
-
-    async def dc2tg(self) -> None:
-        while True:
-            try:
-                file_: Any = ""
-                tgchat, dcmsg = await msgs_queue.aget()
-                self.dcbot.logger.debug(f"Sending message (id={dcmsg.id}) to Telegram")
-                if dcmsg.filename:
-                    if dcmsg.filename.endswith(".aac"):
-                        file_ = self._acc2mp3(dcmsg.filename)
-                    else:
-                        file_ = dcmsg.filename
-                elif dcmsg.html:
-                    tmpfile = NamedTemporaryFile(suffix=".html")  # noqa
-                    tmpfile.write(dcmsg.html.encode(errors="replace"))
-                    tmpfile.seek(0)
-                    file_ = tmpfile
-                if not dcmsg.text and not file_:
-                    self.dcbot.logger.debug(
-                        f"Ignoring unsupported message (id={dcmsg.id})"
-                    )
-                    return
-                reply_to = None
-                if dcmsg.quote:
-                    reply_to = self.cache.get(f"d{tgchat}/{dcmsg.quote.id}")
-                name = (
-                    dcmsg.override_sender_name
-                    or dcmsg.get_sender_contact().display_name
-                )
-                text = f"**{shorten_text(name, 30)}:** {dcmsg.text}"
-                tgmsg = await self.send_message(
-                    tgchat, text, file=file_ or None, reply_to=reply_to
-                )
-                self.cache.set(f"d{tgchat}/{dcmsg.id}", tgmsg.id)
-                self.cache.set(f"t{tgchat}/{tgmsg.id}", dcmsg.id)
-            except (ChannelPrivateError, ChatIdInvalidError, ValueError) as ex:
-                self.dcbot.logger.exception(ex)
-                try:
-                    unbridged_chats = []
-                    with session_scope() as session:
-                        for link in session.query(Link).filter_by(tgchat=tgchat):
-                            self.dcbot.logger.debug(
-                                f"Removing bridge between {link.tgchat}) and {link.dcchat}"
-                            )
-                            unbridged_chats.append(link.dcchat)
-                            session.delete(link)
-                    replies = Replies(dcmsg, self.dcbot.logger)
-                    for chat_id in unbridged_chats:
-                        replies.add(
-                            text=(
-                                "❌ Chat unbridged from Telegram chat, make sure the chat ID is correct"
-                                " or that the bot was not removed from the Telegram chat"
-                            ),
-                            chat=self.dcbot.get_chat(chat_id),
-                        )
-                        replies.send_reply_messages()
-                except Exception as err:
-                    self.dcbot.logger.exception(err)
-            except Exception as ex:
-                self.dcbot.logger.exception(ex)
-            finally:
-                if not isinstance(file_, str):
-                    try:
-                        file_.close()
-                    except Exception as ex:
-                        self.dcbot.logger.exception(ex)
-
-    async def tg2dc(self, event: events.NewMessage) -> None:
-        self.dcbot.logger.debug(
-            f"Got message (id={event.message.id}) from Telegram chat (id={event.chat_id})"
-        )
-        tgmsg = event.message
-        if tgmsg.text is None:
-            return
-        with session_scope() as session:
-            dcchats = [
-                link.dcchat
-                for link in session.query(Link).filter_by(tgchat=event.chat_id)
-            ]
-        if not dcchats:
-            self.dcbot.logger.debug(
-                f"Ignoring message from Telegram chat (id={event.chat_id})"
-            )
-            return
-
-        replies = Replies(self.dcbot, self.dcbot.logger)
-        sender = "[UNKNOWN SENDER]"
-        if tgmsg.sender:
-            if hasattr(tgmsg.sender, "first_name"):
-                sender = " ".join(
-                    (tgmsg.sender.first_name or "", tgmsg.sender.last_name or "")
-                ).strip()
-            elif hasattr(tgmsg.sender, "title"):
-                sender = tgmsg.sender.title
-        args = dict(text=tgmsg.text, sender=sender)
-        with TemporaryDirectory() as tempdir:
-            if tgmsg.file and tgmsg.file.size <= int(
-                getdefault(self.dcbot, "max_size")
-            ):
-                args["filename"] = await tgmsg.download_media(tempdir)
-                if args["filename"] and tgmsg.sticker:
-                    args["viewtype"] = "sticker"
-            if not args.get("text") and not args.get("filename"):
-                return
-            if tgmsg.reply_to and tgmsg.reply_to.reply_to_msg_id:
-                quote_id = self.cache.get(
-                    f"t{event.chat_id}/{tgmsg.reply_to.reply_to_msg_id}"
-                )
-                if quote_id:
-                    try:
-                        args["quote"] = self.dcbot.account.get_message_by_id(quote_id)
-                    except Exception as ex:
-                        self.dcbot.logger.exception(ex)
-            for chat_id in dcchats:
-                try:
-                    replies.add(**args, chat=self.dcbot.get_chat(chat_id))
-                    dcmsg = replies.send_reply_messages()[0]
-                    self.cache.set(f"d{event.chat_id}/{dcmsg.id}", tgmsg.id)
-                    self.cache.set(f"t{event.chat_id}/{tgmsg.id}", dcmsg.id)
-                except Exception as ex:
-                    self.dcbot.logger.exception(ex)
+        return TelegramBot
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @simplebot.hookimpl
@@ -220,6 +41,24 @@ def deltabot_init_parser(parser) -> None:
 @simplebot.hookimpl
 def deltabot_init(bot: DeltaBot) -> None:
     getdefault(bot, "max_size", str(1024**2 * 5))
+    getdefault(bot, "stream_max_size", "0")
+    getdefault(bot, "max_workers", "10")
+    getdefault(bot, "queue_size", "1000")
+    getdefault(bot, "max_downloads", "4")
+    getdefault(bot, "global_rate", "30")
+    getdefault(bot, "chat_rate", "20")
+    getdefault(bot, "coalesce_window", "0")
+    getdefault(bot, "coalesce_size", "4096")
+    getdefault(bot, "media_pool", "thread")
+    getdefault(bot, "media_workers", "2")
+    getdefault(bot, "media_timeout", "60")
+    getdefault(bot, "media_cache_size", str(1024**2 * 100))
+    getdefault(bot, "image_size", "0")
+    getdefault(bot, "image_quality", "85")
+    getdefault(bot, "video_bitrate", "0")
+    getdefault(bot, "metrics_port", "0")
+    getdefault(bot, "metrics_file", "")
+    getdefault(bot, "shards", "1")
     tgbot = getdefault(bot, "telegram_bot")
     tgbot = f" @{tgbot}" if tgbot else ""
     desc = f"""To bridge a Telegram group to a Delta Chat group:
@@ -229,18 +68,39 @@ def deltabot_init(bot: DeltaBot) -> None:
     3. Add me to your Delta Chat group.
     4. Send me /bridge command with the group ID obtained in the Telegram group, example: /bridge -1234
     5. Then all messages sent in both groups will be relayed to the other side.
+
+    A group can be bridged with several groups, messages are relayed to all the groups sharing a bridged group, in Delta Chat or Telegram.
     """
     bot.filters.register(filter_messages, help=desc)
 
 
 @simplebot.hookimpl
 def deltabot_start(bot: DeltaBot) -> None:
+    from .orm import init  # noqa
+
     path = os.path.join(os.path.dirname(bot.account.db_path), __name__)
     if not os.path.exists(path):
         os.makedirs(path)
-    path = os.path.join(path, "sqlite.db")
-    init(f"sqlite:///{path}")
-    Thread(target=listen_to_telegram, args=(bot,), daemon=True).start()
+    init(f"sqlite:///{os.path.join(path, 'sqlite.db')}")
+    outbox.open(os.path.join(path, "outbox.db"), int(getdefault(bot, "queue_size")))
+    port = int(getdefault(bot, "metrics_port"))
+    if port:
+        start_http_server(port)
+    if getdefault(bot, "metrics_file"):
+        start_file_dump(getdefault(bot, "metrics_file"), logger=bot.logger)
+    bot.account.add_account_plugin(ContactsListener())
+    shards = int(getdefault(bot, "shards"))
+    if shards > 1:
+        from .ipc import start_workers  # noqa
+
+        start_workers(bot, outbox, shards)
+    else:
+        Thread(target=listen_to_telegram, args=(bot,), daemon=True).start()
+
+
+@simplebot.hookimpl
+def deltabot_shutdown() -> None:
+    stop_telegram()
 
 
 @simplebot.hookimpl
@@ -248,25 +108,28 @@ def deltabot_member_removed(bot: DeltaBot, chat: Chat, contact: Contact) -> None
     if bot.self_contact != contact and len(chat.get_contacts()) > 1:
         return
 
-    with session_scope() as session:
-        for link in session.query(Link).filter_by(dcchat=chat.id):
-            bot.logger.debug(f"Removing bridge with Telegram chat (id={link.tgchat})")
-            session.delete(link)
+    from .orm import links  # noqa
+
+    for tgchat in links.remove(chat.id):
+        bot.logger.debug(f"Removed bridge with Telegram chat (id={tgchat})")
 
 
 def filter_messages(bot: DeltaBot, message: Message) -> None:
     if not message.chat.is_multiuser():
         return
 
-    with session_scope() as session:
-        for link in session.query(Link).filter_by(dcchat=message.chat.id):
-            bot.logger.debug(f"Queuing message (id={message.id}) to Telegram")
-            msgs_queue.put((link.tgchat, message))
+    for tgchat in routes.get_tgchats(message.chat.id):
+        bot.logger.debug(f"Queuing message (id={message.id}) to Telegram")
+        with DB_TIME.time("outbox_put"):
+            outbox.put(tgchat, message.id)
 
 
 @simplebot.command
-def bridge(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
-    """Bridge this chat with the given Telegram chat."""
+def bridge(payload: str, message: Message, replies: Replies) -> None:
+    """Bridge this chat with the given Telegram chat.
+
+    A chat can be bridged with several Telegram chats.
+    """
     try:
         tgchat = int(payload)
     except ValueError:
@@ -279,29 +142,80 @@ def bridge(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> N
         replies.add(text="❌ Bridging is supported in group chats only", quote=message)
         return
 
-    try:
-        with session_scope() as session:
-            session.add(Link(dcchat=message.chat.id, tgchat=tgchat))
+    from .orm import links  # noqa
+
+    if links.add(message.chat.id, tgchat):
         replies.add(text="✔️Bridged", quote=message)
-    except Exception as ex:
-        bot.logger.exception(ex)
-        replies.add(text="❌ This chat is already bridged", quote=message)
+    else:
+        replies.add(
+            text="❌ This chat is already bridged with that Telegram chat", quote=message
+        )
 
 
 @simplebot.command
-def unbridge(message: Message, replies: Replies) -> None:
-    """Remove the bridge between this chat and Telegram."""
-    with session_scope() as session:
-        link = session.query(Link).filter_by(dcchat=message.chat.id).first()
-        if link:
-            session.delete(link)
-            replies.add(text="✔️Bridge removed", quote=message)
-        else:
-            replies.add(text="❌ This chat is not bridged", quote=message)
+def unbridge(payload: str, message: Message, replies: Replies) -> None:
+    """Remove the bridges between this chat and Telegram.
+
+    To remove only the bridge with one Telegram chat, pass the ID of the chat, example:
+    /unbridge -1234
+    """
+    tgchat = None
+    if payload:
+        try:
+            tgchat = int(payload)
+        except ValueError:
+            replies.add(
+                text="❌ You must provide the ID of the Telegram chat", quote=message
+            )
+            return
+
+    from .orm import links  # noqa
+
+    if links.remove(message.chat.id, tgchat):
+        replies.add(text="✔️Bridge removed", quote=message)
+    else:
+        replies.add(text="❌ This chat is not bridged", quote=message)
+
+
+@simplebot.command
+def media(bot: DeltaBot, payload: str, message: Message, replies: Replies) -> None:
+    """Set the limits of the media relayed to and from this chat.
+
+    Send /media to see the current limits. To shrink images to 1280 pixels
+    with JPEG quality 75 and transcode videos to 500 kbps, send: /media 1280 75 500
+    A limit of 0 disables it, to use the default limits again send: /media default
+    """
+    if not message.chat.is_multiuser():
+        replies.add(
+            text="❌ Media limits are supported in group chats only", quote=message
+        )
+        return
+
+    key = f"media_limits_{message.chat.id}"
+    if payload == "default":
+        set_config(bot, key, None)
+    elif payload:
+        try:
+            set_config(bot, key, str(MediaLimits.parse(payload)))
+        except ValueError:
+            replies.add(
+                text="❌ Invalid limits, example: /media 1280 75 500", quote=message
+            )
+            return
+
+    limits = get_media_limits(bot, message.chat.id)
+    image = (
+        f"{limits.image_size}px, quality {limits.image_quality}"
+        if limits.image_size
+        else "original size"
+    )
+    video = f"{limits.video_bitrate} kbps" if limits.video_bitrate else "original"
+    replies.add(text=f"🖼️ Images: {image}\n🎞️ Videos: {video}", quote=message)
 
 
 @sync
-async def listen_to_telegram(dcbot: DeltaBot) -> None:
+async def listen_to_telegram(dcbot: DeltaBot, **kwargs) -> None:
+    """Run the Telegram side, the keyword arguments are passed to TelegramBot."""
     if not all(
         (
             getdefault(dcbot, "api_id"),
@@ -312,8 +226,23 @@ async def listen_to_telegram(dcbot: DeltaBot) -> None:
         dcbot.logger.warning("Telegram session not configured")
         return
 
-    tgbot = await TelegramBot(dcbot).start(bot_token=getdefault(dcbot, "token"))
+    from .tgbot import TelegramBot  # noqa
+
+    tgbot = TelegramBot(dcbot, **kwargs)
+    _tgbots.append(tgbot)
+    await tgbot.start(bot_token=getdefault(dcbot, "token"))
     dcbot.logger.debug("Connected to Telegram")
-    asyncio.create_task(tgbot.set_commands())
+    if not tgbot.shard:
+        asyncio.create_task(tgbot.set_commands())
+    asyncio.create_task(tgbot.backfill())
     asyncio.create_task(tgbot.dc2tg())
+    asyncio.create_task(tgbot.maintenance())
+    if tgbot.shards > 1:
+        asyncio.create_task(tgbot.receive_peer_jobs())
     await tgbot.run_until_disconnected()
+
+
+def stop_telegram() -> None:
+    """Save the message mappings of the Telegram sides running in this process."""
+    while _tgbots:
+        _tgbots.pop().msgmap.close()
@@ -0,0 +1,122 @@
+"""Delta Chat side of the bridge, as seen by the Telegram side."""
+
+from typing import List, NamedTuple, Optional
+
+from deltachat import Message, account_hookimpl
+from simplebot import DeltaBot
+from simplebot.bot import Replies
+
+from .metrics import NAME_LOOKUPS
+from .util import TTLCache, shorten_text
+
+# formatted names of Delta Chat contacts: {contact ID: name}
+dc_names = TTLCache(10_000, 600)
+
+
+class DCMessage(NamedTuple):
+    """Snapshot of the parts of a Delta Chat message relayed to Telegram."""
+
+    id: int
+    chat_id: int
+    text: str
+    html: str
+    filename: str
+    is_sticker: bool
+    quote_id: Optional[int]
+    sender: str
+
+
+class ContactsListener:  # noqa
+    """Forget the cached names of the Delta Chat contacts that changed."""
+
+    @account_hookimpl
+    def ac_process_ffi_event(self, ffi_event) -> None:
+        if ffi_event.name == "DC_EVENT_CONTACTS_CHANGED":
+            if ffi_event.data1:
+                dc_names.pop(ffi_event.data1)
+            else:
+                dc_names.clear()
+
+
+def get_sender_name(msg: Message) -> str:
+    """Get the shortened name of the sender of the message."""
+    if msg.override_sender_name:
+        return shorten_text(msg.override_sender_name, 30)
+    contact = msg.get_sender_contact()
+    name = dc_names.get(contact.id)
+    if name is None:
+        NAME_LOOKUPS.inc("dc", "miss")
+        name = shorten_text(contact.display_name, 30)
+        dc_names.set(contact.id, name)
+    else:
+        NAME_LOOKUPS.inc("dc", "hit")
+    return name
+
+
+class DeltaChatSide:
+    """Operations the Telegram side performs on the Delta Chat account.
+
+    In sharded mode the workers call these methods through IPC, so arguments
+    and results are plain picklable values.
+    """
+
+    def __init__(self, bot: DeltaBot) -> None:
+        self.bot = bot
+
+    def get_blobdir(self) -> str:
+        return self.bot.account.get_blobdir()
+
+    def get_message(self, msgid: int) -> Optional[DCMessage]:
+        """Get a snapshot of the message, or None if it was deleted."""
+        msg = self.bot.account.get_message_by_id(msgid)
+        if msg is None:
+            return None
+        quote = msg.quote
+        return DCMessage(
+            id=msg.id,
+            chat_id=msg.chat.id,
+            text=msg.text,
+            html=msg.html if msg.has_html() else "",
+            filename=msg.filename,
+            is_sticker=msg.is_sticker(),
+            quote_id=quote.id if quote else None,
+            sender=get_sender_name(msg),
+        )
+
+    def send_messages(self, chat_id: int, messages: List[dict]) -> List[int]:
+        """Send messages to the chat and return their IDs.
+
+        :param messages: arguments for ``Replies.add()``, with the ID of the
+                         quoted message in "quote"
+        """
+        replies = Replies(self.bot, self.bot.logger)
+        chat = self.bot.get_chat(chat_id)
+        for args in messages:
+            args = dict(args)
+            quote_id = args.pop("quote", None)
+            quote = self.bot.account.get_message_by_id(quote_id) if quote_id else None
+            replies.add(**args, quote=quote, chat=chat)
+        return [msg.id for msg in replies.send_reply_messages()]
+
+    def delete_messages(self, msgids: List[int]) -> None:
+        """Delete the messages from the bot's account, missing messages are ignored."""
+        messages = list(filter(None, map(self.bot.account.get_message_by_id, msgids)))
+        if messages:
+            self.bot.account.delete_messages(messages)
+
+    def unbridge(self, tgchat: int) -> None:
+        """Remove the bridges with the Telegram chat and notify the Delta Chat chats."""
+        from .orm import links  # noqa
+
+        unbridged_chats = links.remove_tgchat(tgchat)
+        self.bot.logger.debug(f"Removed bridges of {tgchat}: {unbridged_chats}")
+        replies = Replies(self.bot, self.bot.logger)
+        for chat_id in unbridged_chats:
+            replies.add(
+                text=(
+                    "❌ Chat unbridged from Telegram chat, make sure the chat ID is correct"
+                    " or that the bot was not removed from the Telegram chat"
+                ),
+                chat=self.bot.get_chat(chat_id),
+            )
+            replies.send_reply_messages()
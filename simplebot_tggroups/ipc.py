@@ -0,0 +1,342 @@
+"""Sharded mode: the Telegram chats are split among worker processes.
+
+Every worker runs its own Telegram session and event loop and handles only
+the chats of its shard. The Delta Chat account stays in the bot's process,
+the workers reach it through a pipe: they call the methods of
+``DeltaChatSide`` and get the messages to send to Telegram from the outbox
+of the bot's process. Workers get a snapshot of the settings when they start,
+changes to the settings and to the bridges are pushed to all the workers.
+Messages, edits and deletions for Telegram chats of other shards are relayed
+by the bot's process to the worker of the chat.
+"""
+
+import asyncio
+import atexit
+import itertools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from multiprocessing.connection import Connection
+from threading import Lock, Semaphore, Thread
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from simplebot import DeltaBot
+
+from .dcside import DeltaChatSide
+from .metrics import error, start_file_dump, start_http_server
+from .outbox import Outbox
+from .routing import routes
+from .util import (
+    AsyncQueue,
+    Repository,
+    config_listeners,
+    get_settings,
+    get_shard,
+    getdefault,
+    set_config,
+    sync,
+)
+
+# methods of DeltaChatSide the workers are allowed to call
+_METHODS = (
+    "get_message",
+    "send_messages",
+    "delete_messages",
+    "unbridge",
+)
+
+
+class WorkerChannel:  # noqa
+    """The bot's end of the pipe to a worker.
+
+    Up to ``queue_size`` outbox entries are sent to the worker before it takes
+    them from its queue, the rest wait in the bot's outbox.
+    """
+
+    def __init__(
+        self, conn: Connection, dc: DeltaChatSide, outbox: Outbox, queue_size: int
+    ) -> None:
+        self.dc = dc
+        self.outbox = outbox
+        self.credits = Semaphore(queue_size)
+        # channels of all the workers, by shard, set when they are started
+        self.peers: List[WorkerChannel] = [self]
+        self._conn = conn
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(4)
+        self._stopping = False
+        Thread(target=self._serve, daemon=True).start()
+
+    def send(self, *message) -> None:
+        with self._lock:
+            self._conn.send(message)
+
+    def stop(self) -> None:
+        """Ask the worker to save its state and exit."""
+        self._stopping = True
+        self.send("stop")
+
+    def _serve(self) -> None:
+        while True:
+            try:
+                message = self._conn.recv()
+            except EOFError:
+                if not self._stopping:
+                    self.dc.bot.logger.error("Telegram worker exited")
+                return
+            if message[0] == "done":
+                self.outbox.done(message[1])
+            elif message[0] == "taken":
+                self.credits.release()
+            elif message[0] == "peer":
+                self.peers[message[1]].send("peer", *message[2:])
+            elif message[0] == "call":
+                self._executor.submit(self._call, *message[1:])
+
+    def _call(self, call_id: int, method: str, args: tuple) -> None:
+        try:
+            if method not in _METHODS:
+                raise ValueError(f"Unknown method: {method}")
+            self.send("result", call_id, getattr(self.dc, method)(*args), None)
+        except Exception as ex:
+            error(ex)
+            self.dc.bot.logger.exception(ex)
+            self.send("result", call_id, None, repr(ex))
+
+
+class RemoteDeltaChat:  # noqa
+    """The worker's end of the pipe, with the same interface as DeltaChatSide."""
+
+    def __init__(self, conn: Connection, blobdir: str) -> None:
+        self.queue = AsyncQueue()  # (seq, tgchat, dcmsg) entries from the outbox
+        # (method, tgchat, args) jobs of the chats of this shard sent by other shards
+        self.peer_jobs = AsyncQueue()
+        # functions called with (key, value) when a setting changes
+        self.config_handlers: List[Callable[[str, Optional[str]], None]] = []
+        # functions called before the worker exits
+        self.exit_handlers: List[Callable[[], None]] = []
+        self._blobdir = blobdir
+        self._conn = conn
+        self._lock = Lock()
+        self._ids = itertools.count()
+        self._calls: Dict[int, Future] = {}
+        Thread(target=self._receive, daemon=True).start()
+
+    def send(self, *message) -> None:
+        with self._lock:
+            self._conn.send(message)
+
+    def get_blobdir(self) -> str:
+        return self._blobdir
+
+    def send_peer_job(self, shard: int, method: str, tgchat: int, args: tuple) -> None:
+        """Run ``method(tgchat, *args)`` in the worker of the given shard."""
+        self.send("peer", shard, method, tgchat, args)
+
+    def __getattr__(self, method: str):
+        if method not in _METHODS:
+            raise AttributeError(method)
+        return lambda *args: self._call(method, *args)
+
+    def _call(self, method: str, *args):
+        future: Future = Future()
+        with self._lock:
+            call_id = next(self._ids)
+            self._calls[call_id] = future
+            self._conn.send(("call", call_id, method, args))
+        return future.result()
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                message = self._conn.recv()
+            except EOFError:
+                # the bot's process exited
+                self._exit()
+            if message[0] == "stop":
+                self._exit()
+            elif message[0] == "result":
+                _, call_id, result, err = message
+                future = self._calls.pop(call_id)
+                if err is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(err))
+            elif message[0] == "dc2tg":
+                self.queue.put(message[1:])
+            elif message[0] == "peer":
+                self.peer_jobs.put(message[1:])
+            elif message[0] == "route":
+                _, action, dcchat, tgchat = message
+                getattr(routes, action)(dcchat, tgchat)
+            elif message[0] == "config":
+                for handler in self.config_handlers:
+                    handler(*message[1:])
+
+    def _exit(self) -> None:
+        for handler in self.exit_handlers:
+            try:
+                handler()
+            except Exception as ex:
+                logging.getLogger(__name__).exception(ex)
+        os._exit(0)
+
+
+class RemoteOutbox(Repository):
+    """Outbox of the worker, entries are taken from the bot's outbox."""
+
+    def __init__(self, dc: RemoteDeltaChat, replay_until: int) -> None:
+        self.dc = dc
+        self.replay_until = replay_until
+
+    async def get(self) -> Tuple[int, int, int]:
+        entry = await self.dc.queue.aget()
+        self.dc.send("taken")
+        return entry
+
+    def done(self, seqs: Iterable[int]) -> None:
+        seqs = list(seqs)
+        if seqs:
+            self.dc.send("done", seqs)
+
+    def qsize(self) -> int:
+        return self.dc.queue.qsize()
+
+
+class WorkerBot:
+    """Stand-in for the DeltaBot in the workers, provides the configuration and logger.
+
+    The settings are read from the snapshot given by the bot's process, changes
+    are only kept in memory.
+    """
+
+    def __init__(self, settings: Dict[str, str], db_path: str, logger) -> None:
+        self.settings = settings
+        self.account = SimpleNamespace(db_path=db_path)
+        self.logger = logger
+
+    # scope is accepted as in DeltaBot, all the settings are of this plugin
+    def get(
+        self,
+        key: str,
+        default: Optional[str] = None,
+        scope: Optional[str] = None,  # noqa
+    ) -> Optional[str]:
+        value = self.settings.get(key)
+        return default if value is None else value
+
+    def set(
+        self, key: str, value: Optional[str], scope: Optional[str] = None  # noqa
+    ) -> None:
+        if value is None:
+            self.settings.pop(key, None)
+        else:
+            self.settings[key] = value
+
+
+def start_workers(bot: DeltaBot, outbox: Outbox, shards: int) -> List[WorkerChannel]:
+    """Start the worker processes and dispatch the outbox entries to them."""
+    dc = DeltaChatSide(bot)
+    context = multiprocessing.get_context("spawn")
+    channels: List[WorkerChannel] = []
+
+    def broadcast_config(key: str, value: Optional[str]) -> None:
+        for channel in channels:
+            channel.send("config", key, value)
+
+    # registered before the snapshot is taken so no change is missed
+    config_listeners.append(broadcast_config)
+    settings = get_settings(bot)
+    blobdir = dc.get_blobdir()
+    pipes = [context.Pipe() for _ in range(shards)]
+    for conn, _ in pipes:
+        channels.append(
+            WorkerChannel(conn, dc, outbox, int(getdefault(bot, "queue_size")))
+        )
+        # all the channels exist before a worker can send them jobs
+        channels[-1].peers = channels
+    for shard, (_, worker_conn) in enumerate(pipes):
+        # not a daemon so it can start its own pool of processes to convert media
+        process = context.Process(
+            target=run_worker,
+            args=(
+                shard,
+                shards,
+                bot.account.db_path,
+                outbox.replay_until,
+                worker_conn,
+                settings,
+                blobdir,
+            ),
+            name=f"tggroups-shard{shard}",
+        )
+        process.start()
+        atexit.register(_stop_worker, channels[shard], process)
+
+    def broadcast(action: str, dcchat: int, tgchat: int) -> None:
+        for channel in channels:
+            channel.send("route", action, dcchat, tgchat)
+
+    routes.listeners.append(broadcast)
+    Thread(target=_dispatch, args=(outbox, channels), daemon=True).start()
+    return channels
+
+
+def _stop_worker(channel: WorkerChannel, process, timeout: float = 10) -> None:
+    """Let the worker save its state before exiting, terminate it if it takes too long."""
+    try:
+        channel.stop()
+        process.join(timeout)
+    finally:
+        if process.is_alive():
+            process.terminate()
+
+
+@sync
+async def _dispatch(outbox: Outbox, channels: List[WorkerChannel]) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        seq, tgchat, msgid = await outbox.get()
+        channel = channels[get_shard(tgchat, len(channels))]
+        # wait until the worker has room for it
+        await loop.run_in_executor(None, channel.credits.acquire)
+        channel.send("dc2tg", seq, tgchat, msgid)
+
+
+def run_worker(  # noqa
+    shard: int,
+    shards: int,
+    db_path: str,
+    replay_until: int,
+    conn: Connection,
+    settings: Dict[str, str],
+    blobdir: str,
+) -> None:
+    """Entry point of the worker processes."""
+    from . import listen_to_telegram, stop_telegram  # noqa
+    from .orm import init  # noqa
+
+    logger = logging.getLogger(f"{__name__}.shard{shard}")
+    path = os.path.join(os.path.dirname(db_path), __package__)
+    # the bridges are loaded from the shared database, changes are pushed by the bot
+    init(f"sqlite:///{os.path.join(path, 'sqlite.db')}")
+    bot = WorkerBot(settings, db_path, logger)
+    dc = RemoteDeltaChat(conn, blobdir)
+    dc.config_handlers.append(partial(set_config, bot))
+    dc.exit_handlers.append(stop_telegram)
+
+    port = int(getdefault(bot, "metrics_port") or 0)
+    if port:
+        start_http_server(port + 1 + shard)
+    if getdefault(bot, "metrics_file"):
+        start_file_dump(f"{getdefault(bot, 'metrics_file')}.{shard}", logger=logger)
+    listen_to_telegram(
+        bot,
+        dc=dc,
+        journal=RemoteOutbox(dc, replay_until),
+        shard=shard,
+        shards=shards,
+    )
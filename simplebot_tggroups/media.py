@@ -0,0 +1,350 @@
+"""Preparation of media files before relaying them."""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Dict, Optional, Union
+
+from telethon import types
+
+from .metrics import MEDIA_BYTES, MEDIA_CACHE, MEDIA_SAVED, MEDIA_TIME
+from .util import MediaLimits, Repository
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".mkv", ".webm", ".avi")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tgmedia (
+    digest TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    access_hash INTEGER NOT NULL,
+    file_reference BLOB NOT NULL,
+    ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tgmedia_ts ON tgmedia (ts);
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_atime ON files (atime);
+"""
+
+
+def file_digest(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 64), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _acc2mp3(src: str, dest: str) -> None:
+    from pydub import AudioSegment  # noqa
+
+    AudioSegment.from_file(src, "aac").export(dest + ".part", format="mp3")
+    os.replace(dest + ".part", dest)
+
+
+def _shrink_image(src: str, dest: str, max_size: int, quality: int) -> None:
+    from PIL import Image, ImageOps  # noqa
+
+    with Image.open(src) as img:
+        if getattr(img, "is_animated", False) or img.mode not in ("RGB", "L"):
+            # animations and transparency would be lost, keep the original
+            shutil.copyfile(src, dest + ".part")
+        else:
+            rotated = ImageOps.exif_transpose(img)
+            rotated.thumbnail((max_size, max_size))
+            rotated.save(dest + ".part", "JPEG", quality=quality, optimize=True)
+    os.replace(dest + ".part", dest)
+
+
+def _transcode_video(src: str, dest: str, bitrate: int) -> None:
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-y",
+            "-i",
+            src,
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-b:v",
+            f"{bitrate}k",
+            "-maxrate",
+            f"{bitrate}k",
+            "-bufsize",
+            f"{bitrate * 2}k",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "64k",
+            "-movflags",
+            "+faststart",
+            "-f",
+            "mp4",
+            dest + ".part",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    os.replace(dest + ".part", dest)
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path + ".part", "wb") as file:
+        file.write(data)
+    os.replace(path + ".part", path)
+
+
+def _prune(cache_dir: str, max_files: int) -> None:
+    files = [entry for entry in os.scandir(cache_dir) if entry.is_file()]
+    if len(files) > max_files:
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[: len(files) - max_files]:
+            os.remove(entry.path)
+
+
+class MediaPreparer:
+    """Prepare media files off the event loop.
+
+    Conversions run in a pool of processes or threads and their results are
+    cached by content hash, so the same file is converted only once even if
+    it is relayed to several chats.
+    """
+
+    def __init__(  # noqa
+        self,
+        cache_dir: str,
+        logger,
+        pool: str = "thread",
+        workers: int = 2,
+        timeout: float = 60,
+        max_files: int = 200,
+    ) -> None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.logger = logger
+        self.timeout = timeout
+        self.max_files = max_files
+        self.executor: Executor
+        if pool == "process":
+            self.executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+        self._running: Dict[str, asyncio.Future] = {}
+
+    async def audio(self, filename: str) -> str:
+        """Convert AAC voice messages to MP3, on failure the original file is returned."""
+        loop = asyncio.get_running_loop()
+        try:
+            digest = await loop.run_in_executor(None, file_digest, filename)
+            dest = os.path.join(self.cache_dir, f"{digest}.mp3")
+            with MEDIA_TIME.time("transcode"):
+                await self._run(dest, self.executor, _acc2mp3, filename, dest)
+            MEDIA_BYTES.inc("transcode", amount=os.path.getsize(filename))
+            return dest
+        except Exception as ex:
+            self.logger.exception(ex)
+            return filename
+
+    async def optimize(self, filename: str, limits: MediaLimits) -> str:
+        """Shrink images and transcode videos to the given limits.
+
+        Videos are only transcoded if ffmpeg is installed. On failure, or if
+        the result is not smaller, the original file is returned.
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        func: Callable[..., None]
+        if ext in IMAGE_EXTENSIONS and limits.image_size:
+            kind, func, suffix = "image", _shrink_image, ".jpg"
+            args: tuple = (limits.image_size, limits.image_quality)
+        elif (
+            ext in VIDEO_EXTENSIONS and limits.video_bitrate and shutil.which("ffmpeg")
+        ):
+            kind, func, suffix = "video", _transcode_video, ".mp4"
+            args = (limits.video_bitrate,)
+        else:
+            return filename
+        loop = asyncio.get_running_loop()
+        try:
+            digest = await loop.run_in_executor(None, file_digest, filename)
+            name = "-".join(map(str, (digest, *args)))
+            dest = os.path.join(self.cache_dir, name + suffix)
+            with MEDIA_TIME.time(kind):
+                await self._run(dest, self.executor, func, filename, dest, *args)
+        except Exception as ex:
+            self.logger.exception(ex)
+            return filename
+        saved = os.path.getsize(filename) - os.path.getsize(dest)
+        if saved <= 0:
+            return filename
+        MEDIA_SAVED.inc(kind, amount=saved)
+        self.logger.debug(f"Saved {saved} bytes recompressing {filename}")
+        return dest
+
+    async def html(self, html: str) -> str:
+        """Save the HTML part of a message to a file."""
+        data = html.encode(errors="replace")
+        dest = os.path.join(self.cache_dir, f"{hashlib.sha256(data).hexdigest()}.html")
+        await self._run(dest, None, _write_file, dest, data)
+        return dest
+
+    async def _run(self, dest: str, executor: Optional[Executor], func, *args) -> None:
+        """Create dest with func(*args) in the given executor, unless it exists already."""
+        loop = asyncio.get_running_loop()
+        if os.path.exists(dest):
+            os.utime(dest)  # mark as recently used
+            return
+        future = self._running.get(dest)
+        if future is None:
+            future = loop.run_in_executor(executor, func, *args)
+            self._running[dest] = future
+            future.add_done_callback(lambda _: self._running.pop(dest, None))
+            future.add_done_callback(self._on_done)
+        await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def _on_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and not future.exception():
+            future.get_loop().run_in_executor(
+                None, _prune, self.cache_dir, self.max_files
+            )
+
+
+class MediaCache(Repository):
+    """Content-addressed index of the media already relayed.
+
+    Files sent to Telegram are indexed by digest with the reference of the
+    uploaded Telegram document or photo, so the same file is sent again
+    without uploading it. Media downloaded from Telegram is kept in
+    ``cache_dir`` by Telegram ID, so it is not downloaded again, the least
+    recently used files are removed when they take more than ``max_bytes``.
+    """
+
+    def __init__(
+        self, path: str, cache_dir: str, max_bytes: int, max_refs: int = 10_000
+    ) -> None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_refs = max_refs
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+
+    def get_tgmedia(
+        self, digest: str
+    ) -> Optional[Union[types.InputDocument, types.InputPhoto]]:
+        """Get the Telegram media previously sent with a file of the given digest."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kind, id, access_hash, file_reference FROM tgmedia WHERE digest=?",
+                (digest,),
+            ).fetchone()
+        MEDIA_CACHE.inc("tgmedia", "hit" if row else "miss")
+        if not row:
+            return None
+        kind, *args = row
+        if kind == "photo":
+            return types.InputPhoto(*args)
+        return types.InputDocument(*args)
+
+    def add_tgmedia(self, digest: str, tgmsg: types.Message) -> None:
+        """Remember the media of a message sent with a file of the given digest."""
+        if tgmsg.photo:
+            kind, media = "photo", tgmsg.photo
+        elif tgmsg.document:
+            kind, media = "document", tgmsg.document
+        else:
+            return
+        row = (digest, kind, media.id, media.access_hash, media.file_reference)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "REPLACE INTO tgmedia VALUES (?, ?, ?, ?, ?, ?)",
+                    (*row, int(time.time())),
+                )
+                self._db.execute(
+                    "DELETE FROM tgmedia WHERE digest IN (SELECT digest FROM tgmedia"
+                    " ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+                    (self.max_refs,),
+                )
+
+    def forget_tgmedia(self, digest: str) -> None:
+        """Forget the media of the given digest, ex. if its file reference expired."""
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM tgmedia WHERE digest=?", (digest,))
+
+    def get_file(self, key: str) -> Optional[str]:
+        """Get the local copy of the Telegram media with the given key."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path FROM files WHERE key=?", (key,)
+            ).fetchone()
+            if row and not os.path.exists(row[0]):
+                self._db.execute("DELETE FROM files WHERE key=?", (key,))
+                row = None
+            if row:
+                self._db.execute(
+                    "UPDATE files SET atime=? WHERE key=?", (time.time(), key)
+                )
+        MEDIA_CACHE.inc("file", "hit" if row else "miss")
+        return row[0] if row else None
+
+    def add_file(self, key: str, path: str) -> Optional[str]:
+        """Keep a copy of the Telegram media with the given key, return the copy's path."""
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return None
+        folder = os.path.join(self.cache_dir, key)
+        os.makedirs(folder, exist_ok=True)
+        dest = os.path.join(folder, os.path.basename(path))
+        if not os.path.exists(dest):
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (key, dest, size, time.time()),
+                )
+            self._evict()
+        return dest
+
+    def _evict(self) -> None:
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[
+            0
+        ]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, path, size in self._db.execute(
+            "SELECT key, path, size FROM files ORDER BY atime"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            removed.append((key,))
+            total -= size
+        with self._db:
+            self._db.executemany("DELETE FROM files WHERE key=?", removed)
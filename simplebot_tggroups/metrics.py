@@ -0,0 +1,259 @@
+"""Metrics in Prometheus text format."""
+
+import os
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Sequence
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._lock = Lock()
+
+    def _format_labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{key}="{value}"' for key, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(line + "\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{self._format_labels(key)} {val}" for key, val in values]
+
+
+class Gauge(_Metric):
+    """Gauge whose values are collected with a function when rendered.
+
+    The function must return a dictionary mapping label values to values,
+    it is called from the threads rendering the metrics. Errors of the
+    function are counted and its samples are skipped.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._functions: List[Callable[[], Dict[tuple, float]]] = []
+
+    def collect_with(self, func: Callable[[], Dict[tuple, float]]) -> None:
+        self._functions.append(func)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for func in self._functions:
+            try:
+                values = func()
+            except Exception as ex:
+                error(ex)
+                continue
+            for key, val in values.items():
+                lines.append(f"{self.name}{self._format_labels(key)} {val}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = _BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count in +Inf, sum]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *labels) -> "_Timer":
+        """Context manager to observe the time spent in the block."""
+        return _Timer(self, labels)
+
+    def get_count(self, *labels) -> int:
+        return sum(self._values.get(labels, [0, 0])[:-1])
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                labels = self._format_labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {total}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+
+    def counter(self, name: str, help_: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_, labels))
+
+    def gauge(self, name: str, help_: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_, labels))
+
+    def histogram(self, name: str, help_: str, labels: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(name, help_, labels))
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics)
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+registry = Registry()
+RELAYED = registry.counter(
+    "tggroups_messages_relayed_total",
+    "Messages relayed, by direction and Telegram chat",
+    ("direction", "chat"),
+)
+SYNCED = registry.counter(
+    "tggroups_messages_synced_total",
+    "Edits and deletions of Telegram messages applied to the copies, by action and side (dc/tg)",
+    ("action", "side"),
+)
+QUEUE_DEPTH = registry.gauge(
+    "tggroups_queue_depth", "Messages waiting in the queues", ("queue",)
+)
+LANE_DEPTH = registry.gauge(
+    "tggroups_lane_depth",
+    "Messages waiting in the lane of each chat, by queue (dc2tg/tg2dc) and Telegram chat",
+    ("queue", "chat"),
+)
+QUEUE_WAIT = registry.histogram(
+    "tggroups_queue_wait_seconds", "Time messages waited in the queues", ("queue",)
+)
+SEND_LATENCY = registry.histogram(
+    "tggroups_telegram_send_seconds", "Latency of requests to send messages to Telegram"
+)
+MEDIA_TIME = registry.histogram(
+    "tggroups_media_seconds", "Time spent downloading/converting media", ("stage",)
+)
+MEDIA_BYTES = registry.counter(
+    "tggroups_media_bytes_total", "Bytes of media downloaded/converted", ("stage",)
+)
+MEDIA_SAVED = registry.counter(
+    "tggroups_media_saved_bytes_total",
+    "Bytes saved by shrinking images and transcoding videos, by kind (image/video)",
+    ("kind",),
+)
+MEDIA_CACHE = registry.counter(
+    "tggroups_media_cache_lookups_total",
+    "Lookups in the media cache, by kind (tgmedia/file) and result (hit/miss)",
+    ("kind", "result"),
+)
+REPLY_LOOKUPS = registry.counter(
+    "tggroups_reply_lookups_total",
+    "Lookups of replied messages in the message ID cache, by result (hit/miss)",
+    ("result",),
+)
+NAME_LOOKUPS = registry.counter(
+    "tggroups_name_lookups_total",
+    "Lookups of sender names in the cache, by side (dc/tg) and result (hit/miss)",
+    ("side", "result"),
+)
+DB_TIME = registry.histogram(
+    "tggroups_db_seconds", "Time spent in database operations", ("operation",)
+)
+ERRORS = registry.counter("tggroups_errors_total", "Errors, by type", ("type",))
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics in the given local port, in a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_file_dump(path: str, interval: float = 60, logger=None) -> Thread:
+    """Periodically write the metrics to the given file, in a background thread."""
+
+    def dump() -> None:
+        while True:
+            try:
+                with open(path + ".tmp", "w", encoding="utf-8") as file:
+                    file.write(registry.render())
+                os.replace(path + ".tmp", path)
+            except Exception as ex:
+                error(ex)
+                if logger:
+                    logger.exception(ex)
+            time.sleep(interval)
+
+    thread = Thread(target=dump, daemon=True)
+    thread.start()
+    return thread
+
+
+def error(ex: Exception) -> None:
+    """Count the given error."""
+    ERRORS.inc(type(ex).__name__)
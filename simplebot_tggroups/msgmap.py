@@ -0,0 +1,265 @@
+"""Mapping between the IDs of the relayed Telegram and Delta Chat messages."""
+
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from .metrics import DB_TIME, REPLY_LOOKUPS
+from .util import Repository
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS msgmap (
+    tgchat INTEGER NOT NULL,
+    tgmsg INTEGER NOT NULL,
+    dcchat INTEGER NOT NULL,
+    dcmsg INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (tgchat, dcmsg)
+);
+CREATE INDEX IF NOT EXISTS msgmap_tgmsg ON msgmap (tgchat, tgmsg);
+CREATE INDEX IF NOT EXISTS msgmap_ts ON msgmap (ts);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    tgchat INTEGER PRIMARY KEY,
+    tgmsg INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+# chat ID used for mappings migrated from the old cache, where the Delta Chat chat is unknown
+UNKNOWN_CHAT = 0
+
+
+class MessageMap(Repository):  # noqa
+    """Store of the Telegram message ID <-> Delta Chat message ID mappings.
+
+    Mappings are kept in a SQLite table with a LRU cache of the most recent
+    ones in memory, new mappings are written in batches and mappings older
+    than ``max_age`` seconds or exceeding ``max_rows`` are evicted.
+
+    If ``legacy_dir`` is given, mappings not found are looked up in the
+    FileSystemCache used by old versions and copied to the new store, the
+    old cache is deleted after ``max_age`` seconds, when all its entries
+    would have expired anyway.
+    """
+
+    def __init__(  # noqa
+        self,
+        path: str,
+        legacy_dir: Optional[str] = None,
+        max_age: int = 60 * 60 * 24 * 60,
+        max_rows: int = 1_000_000,
+        cache_size: int = 10_000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+    ) -> None:
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # the workers of the sharded mode share the database
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._pending: List[Tuple[int, int, int, int, int]] = []
+        self._pending_checkpoints: Dict[int, int] = {}
+        self._last_flush = time.monotonic()
+        self._dc2tg: OrderedDict = OrderedDict()
+        self._tg2dc: OrderedDict = OrderedDict()
+        self._legacy: Any = None  # FileSystemCache, imported only if needed
+        self._legacy_dir = legacy_dir
+        if legacy_dir and os.path.exists(legacy_dir):
+            self._open_legacy(legacy_dir)
+
+    def add(self, tgchat: int, tgmsg: int, dcchat: int, dcmsg: int) -> None:
+        with self._lock:
+            self._pending.append((tgchat, tgmsg, dcchat, dcmsg, int(time.time())))
+            self._cache_dc2tg((tgchat, dcmsg), tgmsg)
+            dcmsgs = self._tg2dc.get((tgchat, tgmsg))
+            if dcmsgs is not None:
+                dcmsgs[dcchat] = dcmsg
+            self._flush_if_due()
+
+    def set_checkpoint(self, tgchat: int, tgmsg: int) -> None:
+        """Record the last message received from the Telegram chat.
+
+        Checkpoints never go back, they are saved in batches in the same
+        transaction as the pending mappings, so after a restart the messages
+        before the checkpoint have their mappings.
+        """
+        with self._lock:
+            if tgmsg > self._pending_checkpoints.get(tgchat, 0):
+                self._pending_checkpoints[tgchat] = tgmsg
+            self._flush_if_due()
+
+    def get_checkpoints(self) -> Dict[int, int]:
+        """Get the last message received from every Telegram chat."""
+        with self._lock:
+            self._flush()
+            return dict(self._db.execute("SELECT tgchat, tgmsg FROM checkpoint"))
+
+    def get_tgmsg(self, tgchat: int, dcmsg: int) -> Optional[int]:
+        """Get the Telegram message relayed from/to the given Delta Chat message."""
+        return self._get_tgmsg(tgchat, dcmsg)[0]
+
+    def get_quoted_tgmsg(self, tgchat: int, dcmsg: int) -> Optional[int]:
+        """Like ``get_tgmsg()`` for a quoted message, counted in the reply lookup metrics."""
+        tgmsg, hit = self._get_tgmsg(tgchat, dcmsg)
+        REPLY_LOOKUPS.inc("hit" if hit else "miss")
+        return tgmsg
+
+    def get_dcmsg(self, tgchat: int, tgmsg: int, dcchat: int) -> Optional[int]:
+        """Get the message in the given Delta Chat chat relayed from/to the given Telegram message."""
+        dcmsgs = self._get_dcmsgs(tgchat, tgmsg)[0]
+        return dcmsgs.get(dcchat, dcmsgs.get(UNKNOWN_CHAT))
+
+    def get_quoted_dcmsg(self, tgchat: int, tgmsg: int, dcchat: int) -> Optional[int]:
+        """Like ``get_dcmsg()`` for a quoted message, counted in the reply lookup metrics."""
+        dcmsgs, hit = self._get_dcmsgs(tgchat, tgmsg)
+        REPLY_LOOKUPS.inc("hit" if hit else "miss")
+        return dcmsgs.get(dcchat, dcmsgs.get(UNKNOWN_CHAT))
+
+    def get_dcmsgs(self, tgchat: int, tgmsg: int) -> Dict[int, int]:
+        """Get all the Delta Chat messages relayed from/to the given Telegram message.
+
+        The returned dictionary maps Delta Chat chat IDs to message IDs.
+        """
+        return self._get_dcmsgs(tgchat, tgmsg)[0]
+
+    def _get_tgmsg(self, tgchat: int, dcmsg: int) -> Tuple[Optional[int], bool]:
+        """Get the Telegram message and whether it was found in the cache."""
+        key = (tgchat, dcmsg)
+        with self._lock:
+            if key in self._dc2tg:
+                self._dc2tg.move_to_end(key)
+                return self._dc2tg[key], True
+            self._flush()
+            with DB_TIME.time("msgmap_get"):
+                row = self._db.execute(
+                    "SELECT tgmsg FROM msgmap WHERE tgchat=? AND dcmsg=?", key
+                ).fetchone()
+            tgmsg = row[0] if row else self._get_legacy(f"d{tgchat}/{dcmsg}")
+            if tgmsg is not None:
+                if not row:
+                    self._pending.append(
+                        (tgchat, tgmsg, UNKNOWN_CHAT, dcmsg, int(time.time()))
+                    )
+                self._cache_dc2tg(key, tgmsg)
+            return tgmsg, False
+
+    def _get_dcmsgs(self, tgchat: int, tgmsg: int) -> Tuple[Dict[int, int], bool]:
+        """Get the Delta Chat messages and whether they were found in the cache."""
+        key = (tgchat, tgmsg)
+        with self._lock:
+            if key in self._tg2dc:
+                self._tg2dc.move_to_end(key)
+                return dict(self._tg2dc[key]), True
+            self._flush()
+            with DB_TIME.time("msgmap_get"):
+                dcmsgs = dict(
+                    self._db.execute(
+                        "SELECT dcchat, dcmsg FROM msgmap WHERE tgchat=? AND tgmsg=?",
+                        key,
+                    )
+                )
+            if not dcmsgs:
+                dcmsg = self._get_legacy(f"t{tgchat}/{tgmsg}")
+                if dcmsg is not None:
+                    self._pending.append(
+                        (tgchat, tgmsg, UNKNOWN_CHAT, dcmsg, int(time.time()))
+                    )
+                    dcmsgs[UNKNOWN_CHAT] = dcmsg
+            self._tg2dc[key] = dcmsgs
+            if len(self._tg2dc) > self.cache_size:
+                self._tg2dc.popitem(last=False)
+            return dict(dcmsgs), False
+
+    def flush(self) -> None:
+        """Write the pending mappings to the database."""
+        with self._lock:
+            self._flush()
+
+    def evict(self) -> None:
+        """Remove mappings older than max_age and the oldest ones exceeding max_rows."""
+        with self._lock:
+            self._flush()
+            now = int(time.time())
+            with self._db:
+                self._db.execute("DELETE FROM msgmap WHERE ts<?", (now - self.max_age,))
+                self._db.execute(
+                    "DELETE FROM msgmap WHERE rowid IN (SELECT rowid FROM msgmap"
+                    " ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+            self._dc2tg.clear()
+            self._tg2dc.clear()
+            if self._legacy is not None:
+                since = self._db.execute(
+                    "SELECT value FROM meta WHERE key='legacy_since'"
+                ).fetchone()
+                if now - int(since[0]) >= self.max_age:
+                    self._close_legacy()
+
+    def close(self) -> None:
+        """Write the pending mappings and close the database."""
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+    def _flush_if_due(self) -> None:
+        if (
+            len(self._pending) >= self.batch_size
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            self._flush()
+
+    def _flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._pending and not self._pending_checkpoints:
+            return
+        with DB_TIME.time("msgmap_flush"), self._db:
+            self._db.executemany(
+                "REPLACE INTO msgmap (tgchat, tgmsg, dcchat, dcmsg, ts)"
+                " VALUES (?, ?, ?, ?, ?)",
+                self._pending,
+            )
+            self._db.executemany(
+                "INSERT INTO checkpoint (tgchat, tgmsg) VALUES (?, ?)"
+                " ON CONFLICT (tgchat) DO UPDATE SET tgmsg=max(tgmsg, excluded.tgmsg)",
+                self._pending_checkpoints.items(),
+            )
+        self._pending.clear()
+        self._pending_checkpoints.clear()
+
+    def _cache_dc2tg(self, key: tuple, tgmsg: int) -> None:
+        self._dc2tg[key] = tgmsg
+        self._dc2tg.move_to_end(key)
+        if len(self._dc2tg) > self.cache_size:
+            self._dc2tg.popitem(last=False)
+
+    def _open_legacy(self, legacy_dir: str) -> None:
+        from cachelib import FileSystemCache  # pylint: disable=C0415
+
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('legacy_since', ?)",
+                (str(int(time.time())),),
+            )
+        self._legacy = FileSystemCache(legacy_dir, threshold=0)
+
+    def _get_legacy(self, key: str) -> Optional[int]:
+        if self._legacy is None:
+            return None
+        return self._legacy.get(key)
+
+    def _close_legacy(self) -> None:
+        if self._legacy_dir:
+            shutil.rmtree(self._legacy_dir, ignore_errors=True)
+        self._legacy = None
+        with self._db:
+            self._db.execute("DELETE FROM meta WHERE key='legacy_since'")
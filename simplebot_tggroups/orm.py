@@ -1,11 +1,16 @@
 """database"""
 
 from contextlib import contextmanager
-from threading import Lock
+from typing import List, Optional
 
-from sqlalchemy import Column, Integer, create_engine
+from sqlalchemy import Column, Integer, create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from .routing import routes
+from .util import Repository
 
 
 # pylama:ignore=R0903
@@ -17,31 +22,120 @@ class Base:
 
 Base = declarative_base(cls=Base)  # noqa
 _Session = sessionmaker()
-_lock = Lock()
 
 
 class Link(Base):
     dcchat = Column(Integer, primary_key=True)
-    tgchat = Column(Integer)
+    tgchat = Column(Integer, primary_key=True, index=True)
 
 
 @contextmanager
 def session_scope():
-    """Provide a transactional scope around a series of operations."""
-    with _lock:
-        session = _Session()
+    """Provide a transactional scope around a series of operations.
+
+    Sessions take their own connection from the pool, concurrent writers
+    wait for each other in SQLite (busy timeout) instead of a global lock.
+    """
+    session = _Session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+class LinkRepository(Repository):
+    """Bridges between Delta Chat and Telegram chats, kept in sync with ``routes``."""
+
+    def add(self, dcchat: int, tgchat: int) -> bool:
+        """Add a bridge, return False if it already exists."""
         try:
-            yield session
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+            with session_scope() as session:
+                session.add(Link(dcchat=dcchat, tgchat=tgchat))  # noqa
+        except IntegrityError:
+            return False
+        routes.add(dcchat, tgchat)
+        return True
+
+    def remove(self, dcchat: int, tgchat: Optional[int] = None) -> List[int]:
+        """Remove the bridges of the Delta Chat chat, or only the one with tgchat.
+
+        Returns the Telegram chats that were unbridged.
+        """
+        query = dict(dcchat=dcchat)
+        if tgchat is not None:
+            query["tgchat"] = tgchat
+        with session_scope() as session:
+            tgchats = []
+            for link in session.query(Link).filter_by(**query):
+                tgchats.append(link.tgchat)
+                session.delete(link)
+        for chat_id in tgchats:
+            routes.remove(dcchat, chat_id)
+        return tgchats
+
+    def remove_tgchat(self, tgchat: int) -> List[int]:
+        """Remove the bridges of the Telegram chat, return the unbridged Delta Chat chats."""
+        with session_scope() as session:
+            dcchats = []
+            for link in session.query(Link).filter_by(tgchat=tgchat):
+                dcchats.append(link.dcchat)
+                session.delete(link)
+        for chat_id in dcchats:
+            routes.remove(chat_id, tgchat)
+        return dcchats
+
+
+links = LinkRepository()
+
+
+def _set_sqlite_pragmas(dbapi_connection, _) -> None:
+    cursor = dbapi_connection.cursor()
+    # readers don't block the writer and vice versa
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
 
 
 def init(path: str, debug: bool = False) -> None:
     """Initialize engine."""
-    engine = create_engine(path, echo=debug)
+    engine = create_engine(
+        path,
+        echo=debug,
+        poolclass=QueuePool,
+        pool_size=5,
+        connect_args={"check_same_thread": False},
+    )
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    _migrate(engine)
     Base.metadata.create_all(engine)  # noqa
+    for index in Link.__table__.indexes:  # noqa
+        # tables created by old versions don't have the indexes
+        index.create(engine, checkfirst=True)
     _Session.configure(bind=engine)
+    with session_scope() as session:
+        routes.load((link.dcchat, link.tgchat) for link in session.query(Link))
+
+
+def _migrate(engine) -> None:
+    """Upgrade the tables created by old versions."""
+    inspector = inspect(engine)
+    if "link" not in inspector.get_table_names():
+        return
+    if inspector.get_pk_constraint("link")["constrained_columns"] == ["dcchat"]:
+        # old versions allowed a single Telegram chat per Delta Chat chat
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE link RENAME TO link_old"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_link_tgchat"))
+            Link.__table__.create(conn)  # noqa
+            conn.execute(
+                text(
+                    "INSERT INTO link (dcchat, tgchat)"
+                    " SELECT dcchat, tgchat FROM link_old WHERE tgchat IS NOT NULL"
+                )
+            )
+            conn.execute(text("DROP TABLE link_old"))
@@ -0,0 +1,94 @@
+"""Durable queue of the Delta Chat messages pending to be sent to Telegram."""
+
+import sqlite3
+from threading import Lock
+from typing import Iterable, Optional, Tuple
+
+from .util import AsyncQueue, Repository
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tgchat INTEGER NOT NULL,
+    dcmsg INTEGER NOT NULL
+);
+"""
+
+
+class Outbox(Repository):
+    """Journal of the messages to send to Telegram, the journal stores only IDs.
+
+    Entries are kept in the database until they are marked as done, so they
+    are sent again after a restart (at-least-once delivery). Up to
+    ``memory_limit`` entries are also kept in memory, when the limit is
+    reached new entries are only saved to disk and they are loaded again as
+    soon as the in-memory queue is drained.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._queue = AsyncQueue()
+        self._spilled = False
+        self._last_seq = 0
+        self.replay_until = 0
+
+    def open(self, path: str, memory_limit: int = 1000) -> None:
+        with self._lock:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+            # an unbounded queue would never load the entries spilled to disk
+            self._queue = AsyncQueue(max(memory_limit, 1))
+            # entries left from the last run are loaded from disk before the new ones
+            self.replay_until = self._db.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM outbox"
+            ).fetchone()[0]
+            self._spilled = bool(self.replay_until)
+
+    def put(self, tgchat: int, dcmsg: int) -> None:
+        assert self._db, "outbox not opened"
+        with self._lock:
+            with self._db:
+                seq = self._db.execute(
+                    "INSERT INTO outbox (tgchat, dcmsg) VALUES (?, ?)", (tgchat, dcmsg)
+                ).lastrowid
+            if not self._spilled:
+                if self._queue.full():
+                    self._spilled = True
+                else:
+                    self._queue.put_nowait((seq, tgchat, dcmsg))
+
+    async def get(self) -> Tuple[int, int, int]:
+        """Get the next (seq, tgchat, dcmsg) entry, must be called from a single consumer."""
+        assert self._db, "outbox not opened"
+        with self._lock:
+            if self._spilled and self._queue.empty():
+                rows = self._db.execute(
+                    "SELECT seq, tgchat, dcmsg FROM outbox WHERE seq>? ORDER BY seq LIMIT ?",
+                    (self._last_seq, self._queue.maxsize),
+                ).fetchall()
+                for row in rows:
+                    self._queue.put_nowait(row)
+                self._spilled = len(rows) == self._queue.maxsize
+        item = await self._queue.aget()
+        self._last_seq = item[0]
+        return item
+
+    def done(self, seqs: Iterable[int]) -> None:
+        """Remove the given entries from the journal."""
+        assert self._db, "outbox not opened"
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "DELETE FROM outbox WHERE seq=?", ((seq,) for seq in seqs)
+                )
+
+    def qsize(self) -> int:
+        """Get the number of entries pending in memory."""
+        return self._queue.qsize()
+
+
+# outbox of the bot's process, opened when the bot starts
+outbox = Outbox()
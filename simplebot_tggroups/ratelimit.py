@@ -0,0 +1,96 @@
+"""Rate limiting of requests sent to Telegram."""
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from telethon.errors import FloodWaitError
+
+from .metrics import QUEUE_WAIT, SEND_LATENCY
+from .util import idle
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations.
+
+    Every call to ``reserve()`` takes a token, possibly from the future, and
+    returns the seconds the caller must wait before using it, so callers are
+    served in the order they made the reservation.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Don't hand out tokens during the given seconds."""
+        self.reserve()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class SendScheduler:  # noqa
+    """Schedule requests to Telegram respecting the global and per-chat limits.
+
+    Requests that fail with FloodWaitError are retried after the requested
+    time, up to ``max_retries`` times. While waiting, the worker slot of the
+    calling ChatDispatcher lane is given back.
+    """
+
+    def __init__(
+        self,
+        logger,
+        global_rate: float = 30,
+        chat_rate: float = 20 / 60,
+        chat_capacity: float = 3,
+        max_retries: int = 5,
+    ) -> None:
+        self.logger = logger
+        self.chat_rate = chat_rate
+        self.chat_capacity = chat_capacity
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+
+    async def send(self, chat_id: int, request: Callable[[], Awaitable[T]]) -> T:
+        """Wait for the chat's turn and send the request returned by the given function."""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_capacity)
+            self._chats[chat_id] = bucket
+        queued = time.monotonic()
+        retries = 0
+        while True:
+            delay = max(bucket.reserve(), self._global.reserve())
+            if delay:
+                async with idle():
+                    await asyncio.sleep(delay)
+            waited = time.monotonic() - queued
+            try:
+                with SEND_LATENCY.time():
+                    result = await request()
+                QUEUE_WAIT.observe(waited, "ratelimit")
+                self.logger.debug(
+                    f"Request to Telegram chat (id={chat_id}) delayed {waited:.2f} seconds"
+                )
+                return result
+            except FloodWaitError as ex:
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                self.logger.warning(
+                    f"Flood wait of {ex.seconds} seconds in Telegram chat (id={chat_id})"
+                )
+                bucket.pause(ex.seconds)
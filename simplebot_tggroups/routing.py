@@ -0,0 +1,92 @@
+"""In-memory routing table of the bridges."""
+
+from threading import Lock
+from typing import Callable, Dict, FrozenSet, Iterable, List, Tuple
+
+
+class RoutingTable:
+    """In-memory copy of the bridges, to avoid querying the database on every message.
+
+    Lookups don't need any lock, the table must be updated after every change
+    in the database (write-through). Listeners are called with ("add" or
+    "remove", dcchat, tgchat) after every change.
+    """
+
+    def __init__(self) -> None:
+        self.listeners: List[Callable[[str, int, int], None]] = []
+        self._lock = Lock()
+        self._dc2tg: Dict[int, FrozenSet[int]] = {}
+        self._tg2dc: Dict[int, FrozenSet[int]] = {}
+
+    def load(self, links: Iterable[Tuple[int, int]]) -> None:
+        with self._lock:
+            self._dc2tg, self._tg2dc = {}, {}
+            for dcchat, tgchat in links:
+                self._add(dcchat, tgchat)
+
+    def add(self, dcchat: int, tgchat: int) -> None:
+        with self._lock:
+            self._add(dcchat, tgchat)
+        for listener in self.listeners:
+            listener("add", dcchat, tgchat)
+
+    def remove(self, dcchat: int, tgchat: int) -> None:
+        with self._lock:
+            _discard(self._dc2tg, dcchat, tgchat)
+            _discard(self._tg2dc, tgchat, dcchat)
+        for listener in self.listeners:
+            listener("remove", dcchat, tgchat)
+
+    def get_tgchats(self, dcchat: int) -> FrozenSet[int]:
+        """Get the Telegram chats bridged with the given Delta Chat chat."""
+        return self._dc2tg.get(dcchat, frozenset())
+
+    def get_dcchats(self, tgchat: int) -> FrozenSet[int]:
+        """Get the Delta Chat chats bridged with the given Telegram chat."""
+        return self._tg2dc.get(tgchat, frozenset())
+
+    def get_dc_peers(self, dcchat: int) -> Dict[int, int]:
+        """Get the Delta Chat chats sharing a Telegram chat with the given chat.
+
+        Each peer is mapped to the Telegram chat it is reached through, if they
+        share several Telegram chats the one with the lowest ID is used, so the
+        peer gets every message only once.
+        """
+        peers: Dict[int, int] = {}
+        for tgchat in sorted(self.get_tgchats(dcchat)):
+            for peer in self.get_dcchats(tgchat):
+                if peer != dcchat:
+                    peers.setdefault(peer, tgchat)
+        return peers
+
+    def get_tg_peers(self, tgchat: int) -> Dict[int, int]:
+        """Get the Telegram chats sharing a Delta Chat chat with the given chat.
+
+        Each peer is mapped to the Delta Chat chat it is reached through, if
+        they share several Delta Chat chats the one with the lowest ID is used.
+        """
+        peers: Dict[int, int] = {}
+        for dcchat in sorted(self.get_dcchats(tgchat)):
+            for peer in self.get_tgchats(dcchat):
+                if peer != tgchat:
+                    peers.setdefault(peer, dcchat)
+        return peers
+
+    def __len__(self) -> int:
+        return sum(len(chats) for chats in self._dc2tg.values())
+
+    def _add(self, dcchat: int, tgchat: int) -> None:
+        # sets are replaced instead of modified so readers never see them changing
+        self._dc2tg[dcchat] = self._dc2tg.get(dcchat, frozenset()) | {tgchat}
+        self._tg2dc[tgchat] = self._tg2dc.get(tgchat, frozenset()) | {dcchat}
+
+
+def _discard(table: Dict[int, FrozenSet[int]], key: int, value: int) -> None:
+    values = table.get(key, frozenset()) - {value}
+    if values:
+        table[key] = values
+    else:
+        table.pop(key, None)
+
+
+routes = RoutingTable()
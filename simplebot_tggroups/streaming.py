@@ -0,0 +1,115 @@
+"""Chunked transfers of files to and from Telegram that resume after connection errors.
+
+Only one chunk is kept in memory at a time, so big files can be relayed
+without memory spikes.
+"""
+
+import asyncio
+import logging
+import os
+import random
+from contextlib import suppress
+from typing import Union
+
+from telethon import TelegramClient, functions, types
+
+from .metrics import error
+
+CHUNK_SIZE = 512 * 1024
+# files bigger than this must be uploaded as "big files"
+BIG_FILE_SIZE = 10 * 1024 * 1024
+MAX_RETRIES = 5
+_RETRY_ERRORS = (ConnectionError, asyncio.TimeoutError)
+
+
+async def download(  # noqa
+    client: TelegramClient,
+    media,
+    path: str,
+    max_size: int,
+    logger: logging.Logger,
+    max_retries: int = MAX_RETRIES,
+) -> bool:
+    """Download the media to the given path, resuming from the last chunk on errors.
+
+    Returns False if the file is bigger than ``max_size``. The file is removed
+    unless the download completes, also if it fails or is cancelled.
+    """
+    offset = 0
+    retries = 0
+    complete = False
+    try:
+        with open(path, "wb") as file:
+            while True:
+                try:
+                    async for chunk in client.iter_download(
+                        media, offset=offset, request_size=CHUNK_SIZE
+                    ):
+                        if offset + len(chunk) > max_size:
+                            break
+                        file.write(chunk)
+                        offset += len(chunk)
+                    else:
+                        complete = True
+                        return True
+                except _RETRY_ERRORS as ex:
+                    error(ex)
+                    retries += 1
+                    if retries > max_retries:
+                        raise
+                    logger.warning(
+                        f"Download interrupted ({ex!r}), resuming at {offset}"
+                    )
+                    await asyncio.sleep(retries)
+                    # chunks are only written whole, but drop any partial write anyway
+                    file.truncate(offset)
+                    file.seek(offset)
+                    continue
+                break
+    finally:
+        if not complete:
+            with suppress(OSError):
+                os.remove(path)
+    return False
+
+
+async def upload(
+    client: TelegramClient,
+    path: str,
+    logger: logging.Logger,
+    max_retries: int = MAX_RETRIES,
+) -> Union[types.InputFile, types.InputFileBig]:
+    """Upload the file part by part, on errors only the failed parts are sent again."""
+    size = os.path.getsize(path)
+    parts = max(1, (size + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    big = size > BIG_FILE_SIZE
+    file_id = random.getrandbits(63)
+    retries = 0
+    with open(path, "rb") as file:
+        part = 0
+        while part < parts:
+            file.seek(part * CHUNK_SIZE)
+            data = file.read(CHUNK_SIZE)
+            if big:
+                request = functions.upload.SaveBigFilePartRequest(
+                    file_id, part, parts, data
+                )
+            else:
+                request = functions.upload.SaveFilePartRequest(file_id, part, data)
+            try:
+                if not await client(request):
+                    raise ConnectionError(f"Failed to upload part {part} of {path}")
+            except _RETRY_ERRORS as ex:
+                error(ex)
+                retries += 1
+                if retries > max_retries:
+                    raise
+                logger.warning(f"Upload interrupted ({ex!r}), resuming at part {part}")
+                await asyncio.sleep(retries)
+                continue
+            part += 1
+
+    name = os.path.basename(path)
+    if big:
+        return types.InputFileBig(file_id, parts, name)
+    return types.InputFile(file_id, parts, name, "")
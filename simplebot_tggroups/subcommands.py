@@ -1,12 +1,133 @@
 """extra command line subcommands for simplebot's CLI"""
 
+import glob
 import os
+from typing import Dict, Optional, Tuple
 
 from simplebot import DeltaBot
-from telethon import TelegramClient
 
 from .util import get_session_path, getdefault, set_config, sync
 
+# options to tweak the default configuration: (option, config key, help)
+_TWEAKS = [
+    ("max-size", "max_size", "maximum attachment size allowed to be bridged"),
+    (
+        "stream-max-size",
+        "stream_max_size",
+        "maximum size of Telegram attachments streamed to disk when bigger than max-size, 0 to disable",
+    ),
+    (
+        "max-workers",
+        "max_workers",
+        "maximum number of messages sent to Telegram concurrently",
+    ),
+    (
+        "queue-size",
+        "queue_size",
+        "maximum number of messages to Telegram kept in memory, the rest wait on disk",
+    ),
+    (
+        "max-downloads",
+        "max_downloads",
+        "maximum number of Telegram messages processed concurrently",
+    ),
+    (
+        "global-rate",
+        "global_rate",
+        "maximum messages per second sent to Telegram",
+    ),
+    (
+        "chat-rate",
+        "chat_rate",
+        "maximum messages per minute sent to a Telegram chat",
+    ),
+    (
+        "coalesce-window",
+        "coalesce_window",
+        "seconds to wait for more Delta Chat messages to merge into one Telegram message, 0 to disable",
+    ),
+    (
+        "coalesce-size",
+        "coalesce_size",
+        "maximum length of merged messages",
+    ),
+    (
+        "metrics-port",
+        "metrics_port",
+        "local port where to serve metrics in Prometheus format, 0 to disable",
+    ),
+    (
+        "metrics-file",
+        "metrics_file",
+        "file where to save metrics in Prometheus format every minute",
+    ),
+    (
+        "media-pool",
+        "media_pool",
+        "kind of pool used to convert media files: thread or process",
+    ),
+    ("media-workers", "media_workers", "number of workers to convert media files"),
+    (
+        "media-timeout",
+        "media_timeout",
+        "maximum seconds to wait for a media conversion before sending the original file",
+    ),
+    (
+        "media-cache-size",
+        "media_cache_size",
+        "maximum bytes of Telegram media kept on disk to avoid downloading it again",
+    ),
+    (
+        "shards",
+        "shards",
+        "number of worker processes the Telegram chats are split among, 1 to run in the bot's process",
+    ),
+    (
+        "image-size",
+        "image_size",
+        "maximum width and height in pixels of relayed images, bigger ones are shrunk, 0 to disable",
+    ),
+    ("image-quality", "image_quality", "JPEG quality of shrunk images"),
+    (
+        "video-bitrate",
+        "video_bitrate",
+        "bitrate in kbps videos are transcoded to with ffmpeg, 0 to disable",
+    ),
+]
+
+# allowed (minimum, maximum) of the numeric tweaks, None if unbounded,
+# the values of tweaks with a float minimum can have decimals
+_RANGES: Dict[str, Tuple[float, Optional[float]]] = {
+    "max_workers": (1, None),
+    "max_downloads": (1, None),
+    "queue_size": (1, None),
+    "global_rate": (0.01, None),
+    "chat_rate": (0.01, None),
+    "image_size": (0, None),
+    "image_quality": (1, 95),
+    "video_bitrate": (0, None),
+}
+
+
+def _check_tweak(key: str, value: str) -> None:
+    """Raise ValueError if the value is out of the tweak's range."""
+    if key not in _RANGES:
+        return
+    minimum, maximum = _RANGES[key]
+    number: Optional[float]
+    try:
+        number = float(value) if isinstance(minimum, float) else int(value)
+    except ValueError:
+        number = None
+    # written so NaN is rejected too
+    if (
+        number is None
+        or not number >= minimum
+        or (maximum is not None and number > maximum)
+    ):
+        bounds = f"{minimum}-{maximum}" if maximum is not None else f">={minimum}"
+        raise ValueError(f"Invalid value for {key}: {value!r}, expected {bounds}")
+
 
 # pylama:ignore=C0103
 class telegram:
@@ -16,14 +137,21 @@ class telegram:
         parser.add_argument("--api-id", help="set the API ID")
         parser.add_argument("--api-hash", help="set the API hash")
         parser.add_argument("--token", help="set the bot token")
-        parser.add_argument(
-            "--max-size", help="set the maximum attachment size allowed to be bridged"
-        )
+        for option, key, help_ in _TWEAKS:
+            parser.add_argument(f"--{option}", dest=key, help=f"set the {help_}")
 
     def run(self, bot: DeltaBot, args, out) -> None:
-        if args.max_size:
-            set_config(bot, "max_size", args.max_size)
-            out.line("Maximum attachment size updated.")
+        for _, key, _ in _TWEAKS:
+            if getattr(args, key):
+                _check_tweak(key, getattr(args, key))
+        tweaked = False
+        for _, key, help_ in _TWEAKS:
+            value = getattr(args, key)
+            if value:
+                set_config(bot, key, value)
+                out.line(f"{help_.capitalize()} updated.")
+                tweaked = True
+        if tweaked:
             return
 
         if args.api_id:
@@ -42,9 +170,10 @@ class telegram:
 
         if args.token:
             set_config(bot, "token", args.token)
-            path = get_session_path(bot)
-            if os.path.exists(path):
-                # remove session database to avoid conflicts with new token
+            # remove session databases, also the ones of the sharded mode's
+            # workers, to avoid conflicts with new token
+            folder = os.path.dirname(get_session_path(bot))
+            for path in glob.glob(os.path.join(folder, "telegram*.session")):
                 os.remove(path)
             out.line("token updated.")
         elif not getdefault(bot, "token"):
@@ -56,6 +185,8 @@ class telegram:
 
 @sync
 async def _configure(dcbot) -> None:
+    from telethon import TelegramClient  # noqa
+
     client = await TelegramClient(
         get_session_path(dcbot),
         api_id=getdefault(dcbot, "api_id"),
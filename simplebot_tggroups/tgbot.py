@@ -0,0 +1,1036 @@
+"""Telegram side of the bridge."""
+
+import asyncio
+import os
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from simplebot import DeltaBot
+from telethon import TelegramClient, events, functions, types
+from telethon.errors.rpcerrorlist import (
+    BotMethodInvalidError,
+    ChannelPrivateError,
+    ChatIdInvalidError,
+    FileReferenceEmptyError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError,
+)
+
+from .dcside import DCMessage, DeltaChatSide
+from .ipc import RemoteDeltaChat
+from .media import MediaCache, MediaPreparer, file_digest
+from .metrics import (
+    DB_TIME,
+    LANE_DEPTH,
+    MEDIA_BYTES,
+    MEDIA_TIME,
+    NAME_LOOKUPS,
+    QUEUE_DEPTH,
+    RELAYED,
+    SYNCED,
+    error,
+)
+from .msgmap import MessageMap
+from .outbox import Outbox, outbox
+from .ratelimit import SendScheduler
+from .routing import routes
+from .streaming import BIG_FILE_SIZE, download, upload
+from .util import (
+    ChatDispatcher,
+    MediaLimits,
+    TTLCache,
+    get_media_limits,
+    get_session_path,
+    get_shard,
+    getdefault,
+    idle,
+    shorten_text,
+)
+
+# seconds to wait for the rest of the items of an album (grouped media)
+ALBUM_WINDOW = 0.5
+ALBUM_MAX_SIZE = 10
+# maximum messages relayed from a chat after a restart, fetched in pages
+BACKFILL_LIMIT = 1000
+BACKFILL_PAGE_SIZE = 100
+# methods the workers of other shards can run for the chats of this shard
+_PEER_METHODS = ("_send_to_tg_peer", "_edit_tg_peer", "_delete_tg_peer")
+# Delta Chat messages prepared recently, shared by the lanes of their Telegram chats
+PREPARED_CACHE_SIZE = 100
+# errors of media sent by reference that must be uploaded again
+_MEDIA_REF_ERRORS = (
+    FileReferenceEmptyError,
+    FileReferenceExpiredError,
+    FileReferenceInvalidError,
+    MediaEmptyError,
+)
+
+
+# pylama:ignore=C0302
+class TelegramBot(TelegramClient):  # noqa
+    """Telegram side of the bridge.
+
+    In sharded mode, ``dcbot`` only provides the configuration and logger,
+    the Delta Chat side is reached through ``dc`` and the messages to send
+    come from ``journal``, and only the chats of the given shard are handled.
+    """
+
+    def __init__(
+        self,
+        dcbot: DeltaBot,
+        dc: DeltaChatSide = None,
+        journal: Outbox = None,
+        shard: int = None,
+        shards: int = 1,
+    ) -> None:
+        super().__init__(
+            get_session_path(dcbot, shard),
+            api_id=getdefault(dcbot, "api_id"),
+            api_hash=getdefault(dcbot, "api_hash"),
+            # flood waits are handled by the scheduler, which pauses the chat
+            flood_sleep_threshold=0,
+        )
+        self.dcbot = dcbot
+        self.dc = dc or DeltaChatSide(dcbot)
+        self.outbox = journal or outbox
+        self.shard = shard
+        self.shards = shards
+
+        plugin_dir = os.path.join(os.path.dirname(self.dcbot.account.db_path), __name__)
+        if not os.path.exists(plugin_dir):
+            os.makedirs(plugin_dir)
+        self.msgmap = MessageMap(
+            os.path.join(plugin_dir, "msgmap.db"),
+            legacy_dir=os.path.join(plugin_dir, "cache"),
+        )
+
+        self.media = MediaPreparer(
+            os.path.join(plugin_dir, "media"),
+            dcbot.logger,
+            pool=getdefault(dcbot, "media_pool"),
+            workers=int(getdefault(dcbot, "media_workers")),
+            timeout=float(getdefault(dcbot, "media_timeout")),
+        )
+        self.mediacache = MediaCache(
+            os.path.join(plugin_dir, "mediacache.db"),
+            os.path.join(plugin_dir, "mediacache"),
+            int(getdefault(dcbot, "media_cache_size")),
+        )
+        # files sent to the chats of other shards, removed by the worker of the
+        # chat once sent, the ones left by the last run are removed here
+        self.peer_dir = os.path.join(plugin_dir, "peers", str(shard))
+        if shards > 1:
+            shutil.rmtree(self.peer_dir, ignore_errors=True)
+            os.makedirs(self.peer_dir)
+        self.scheduler = SendScheduler(
+            dcbot.logger,
+            global_rate=float(getdefault(dcbot, "global_rate")),
+            chat_rate=float(getdefault(dcbot, "chat_rate")) / 60,
+        )
+        # seconds to wait for more messages to merge, 0 disables coalescing
+        self.coalesce_window = float(getdefault(dcbot, "coalesce_window"))
+        self.coalesce_size = int(getdefault(dcbot, "coalesce_size"))
+        # entries are taken from the outbox only while the lanes have room,
+        # the rest wait in the outbox, spilled to disk if needed
+        self.dc2tg_dispatcher = ChatDispatcher(
+            self._dc2tg,
+            int(getdefault(dcbot, "max_workers")),
+            dcbot.logger,
+            "dc2tg",
+            maxsize=int(getdefault(dcbot, "queue_size")),
+        )
+        # items of the lanes are (handler, argument) so edits and deletions
+        # are applied in order with the new messages of the chat
+        self.tg2dc_dispatcher = ChatDispatcher(
+            lambda tgchat, item: item[0](tgchat, item[1]),
+            int(getdefault(dcbot, "max_downloads")),
+            dcbot.logger,
+            "tg2dc",
+        )
+        QUEUE_DEPTH.collect_with(self._queue_depths)
+        LANE_DEPTH.collect_with(self._lane_depths)
+        # albums being collected: {tgchat: (grouped_id, messages, timer)}
+        self._albums: Dict[int, tuple] = {}
+        # {Delta Chat message ID: future of (message, file)}
+        self._prepared: OrderedDict = OrderedDict()
+        # Delta Chat messages are sent from a single thread, off the event loop
+        self.dc_executor = ThreadPoolExecutor(1)
+        # formatted names of Telegram senders: {sender ID: name}
+        self.tg_names = TTLCache(10_000, 600)
+        # live updates of the chats with messages to backfill, buffered until
+        # backfill() relays the messages missed while the bot was offline: new
+        # messages and the (handler, argument) lane items of edits and deletions
+        self._backfilling: Dict[int, List[Union[types.Message, tuple]]] = {
+            tgchat: []
+            for tgchat in self.msgmap.get_checkpoints()
+            if routes.get_dcchats(tgchat)
+            and (shards <= 1 or get_shard(tgchat, shards) == shard)
+        }
+
+        self.add_event_handler(
+            self.start_cmd,
+            events.NewMessage(pattern="/start", incoming=True, func=self._in_shard),
+        )
+        self.add_event_handler(
+            self.id_cmd,
+            events.NewMessage(pattern="/id", incoming=True, func=self._in_shard),
+        )
+        self.add_event_handler(
+            self.tg2dc, events.NewMessage(incoming=True, func=self._in_shard)
+        )
+        self.add_event_handler(
+            self.tg_edit, events.MessageEdited(incoming=True, func=self._in_shard)
+        )
+        # deletions in basic groups don't tell the chat, the IDs can't be resolved
+        self.add_event_handler(
+            self.tg_delete,
+            events.MessageDeleted(
+                func=lambda e: e.chat_id is not None and self._in_shard(e)
+            ),
+        )
+        self.add_event_handler(
+            self._forget_user_name,
+            events.Raw(types=(types.UpdateUserName, types.UpdateUser)),
+        )
+        self.add_event_handler(
+            self._forget_chat_title, events.ChatAction(func=lambda e: e.new_title)
+        )
+
+    def _lane_depths(self) -> Dict[tuple, float]:
+        """Get the depth of the lanes of the chats, called from the metrics' threads."""
+        depths: Dict[tuple, float] = {}
+        for dispatcher in (self.dc2tg_dispatcher, self.tg2dc_dispatcher):
+            for tgchat, depth in dispatcher.depths().items():
+                depths[(dispatcher.name, tgchat)] = depth
+        return depths
+
+    def _queue_depths(self) -> Dict[tuple, float]:
+        """Get the depth of the queues, called from the metrics' threads."""
+        return {
+            ("outbox",): self.outbox.qsize(),
+            ("dc2tg",): self.dc2tg_dispatcher.qsize(),
+            ("tg2dc",): self.tg2dc_dispatcher.qsize(),
+        }
+
+    def _in_shard(self, event) -> bool:
+        return self._owns(event.chat_id)
+
+    def _owns(self, tgchat: int) -> bool:
+        return self.shards <= 1 or get_shard(tgchat, self.shards) == self.shard
+
+    async def _to_peer(
+        self, peer: int, method: Callable[..., Awaitable[None]], *args
+    ) -> None:
+        """Run ``method(peer, *args)`` in the worker of the Telegram chat ``peer``.
+
+        Chats of other shards are handled in the lane of the chat in its worker,
+        so the worker's rate limits and message mappings apply.
+        """
+        if self._owns(peer):
+            await method(peer, *args)
+        else:
+            assert isinstance(self.dc, RemoteDeltaChat)
+            shard = get_shard(peer, self.shards)
+            self.dc.send_peer_job(shard, method.__name__, peer, args)
+
+    async def receive_peer_jobs(self) -> None:
+        """Queue the jobs sent by other shards for the chats of this shard."""
+        assert isinstance(self.dc, RemoteDeltaChat)
+        while True:
+            method, peer, args = await self.dc.peer_jobs.aget()
+            self.tg2dc_dispatcher.submit(peer, (self._run_peer_job, (method, args)))
+
+    async def _run_peer_job(self, peer: int, job: tuple) -> None:
+        method, args = job
+        if method not in _PEER_METHODS:
+            raise ValueError(f"Unknown method: {method}")
+        await getattr(self, method)(peer, *args)
+
+    async def set_commands(self) -> None:
+        await self(
+            functions.bots.SetBotCommandsRequest(
+                scope=types.BotCommandScopeDefault(),
+                lang_code="en",
+                commands=[
+                    types.BotCommand(
+                        command="id", description="gets the ID of the current chat"
+                    )
+                ],
+            )
+        )
+        self.dcbot.logger.debug("Registered commands on Telegram")
+
+    async def maintenance(self) -> None:
+        """Periodically save pending message mappings and evict old ones."""
+        minutes = 0
+        while True:
+            await asyncio.sleep(60)
+            minutes += 1
+            try:
+                if minutes % 60:
+                    await self.msgmap.run(self.msgmap.flush)
+                else:
+                    await self.msgmap.run(self.msgmap.evict)
+            except Exception as ex:
+                self.dcbot.logger.exception(ex)
+
+    async def _forget_user_name(self, update) -> None:
+        self.tg_names.pop(update.user_id)
+
+    async def _forget_chat_title(self, event: events.ChatAction) -> None:
+        self.tg_names.pop(event.chat_id)
+
+    async def start_cmd(self, event: events.NewMessage) -> None:
+        await event.reply(
+            "This is a Delta Chat bridge relaybot and does not support direct chats"
+        )
+        raise events.StopPropagation
+
+    async def id_cmd(self, event: events.NewMessage) -> None:
+        if event.is_private:
+            text = "❌ You must send that command in a Telegram group, not here"
+        else:
+            text = str(event.chat_id)
+        await event.reply(text)
+        raise events.StopPropagation
+
+    async def dc2tg(self) -> None:
+        while True:
+            await self.dc2tg_dispatcher.wait_for_room()
+            seq, tgchat, msgid = await self.outbox.get()
+            self.dc2tg_dispatcher.submit(tgchat, (seq, msgid))
+
+    async def _dc2tg(self, tgchat: int, item: Tuple[int, int]) -> None:
+        seq, msgid = item
+        seqs = [seq]
+        try:
+            sent = None
+            if seq <= self.outbox.replay_until:
+                sent = await self.msgmap.run(self.msgmap.get_tgmsg, tgchat, msgid)
+            if sent:
+                self.dcbot.logger.debug(f"Message (id={msgid}) was already sent")
+                return
+            prepared = await self._prepare_dcmsg(msgid)
+            if prepared is None:
+                return
+            dcmsg, file_, digest = prepared
+            self.dcbot.logger.debug(f"Sending message (id={dcmsg.id}) to Telegram")
+            reply_to = None
+            if dcmsg.quote_id:
+                reply_to = await self.msgmap.run(
+                    self.msgmap.get_quoted_tgmsg, tgchat, dcmsg.quote_id
+                )
+            text = self._format_dcmsg(dcmsg)
+            dcmsgs = [dcmsg]
+            if not file_ and self.coalesce_window:
+                text = await self._coalesce(tgchat, text, dcmsgs, seqs)
+            tgmsg = await self._send_to_tg(tgchat, text, file_, digest, reply_to)
+            for msg in dcmsgs:
+                await self.msgmap.run(
+                    self.msgmap.add, tgchat, tgmsg.id, msg.chat_id, msg.id
+                )
+            RELAYED.inc("dc2tg", tgchat, amount=len(dcmsgs))
+            await asyncio.get_running_loop().run_in_executor(
+                self.dc_executor, self._send_to_dc_peers, tgchat, tgmsg.id, dcmsgs
+            )
+        except (ConnectionError, asyncio.TimeoutError) as ex:
+            # keep the messages in the outbox to retry them after restart
+            error(ex)
+            self.dcbot.logger.exception(ex)
+            seqs.clear()
+        except (ChannelPrivateError, ChatIdInvalidError, ValueError) as ex:
+            error(ex)
+            self.dcbot.logger.exception(ex)
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.dc_executor, self.dc.unbridge, tgchat
+                )
+            except Exception as err:
+                error(err)
+                self.dcbot.logger.exception(err)
+        except Exception as ex:
+            error(ex)
+            self.dcbot.logger.exception(ex)
+        finally:
+            with DB_TIME.time("outbox_done"):
+                await self.outbox.run(self.outbox.done, seqs)
+
+    async def _send_to_tg(
+        self,
+        tgchat: int,
+        text: str,
+        file_: str,
+        digest: Optional[str],
+        reply_to: Optional[int],
+    ) -> types.Message:
+        """Send a message to Telegram, reusing the media sent before with the same file."""
+        media = digest and await self.mediacache.run(
+            self.mediacache.get_tgmedia, digest
+        )
+        if digest and media:
+            try:
+                return await self.scheduler.send(
+                    tgchat,
+                    lambda: self.send_message(
+                        tgchat, text, file=media, reply_to=reply_to
+                    ),
+                )
+            except _MEDIA_REF_ERRORS as ex:
+                self.dcbot.logger.debug(f"Cached media can't be reused: {ex!r}")
+                await self.mediacache.run(self.mediacache.forget_tgmedia, digest)
+
+        if file_ and os.path.getsize(file_) > BIG_FILE_SIZE:
+            file_ = await upload(self, file_, self.dcbot.logger)
+        tgmsg = await self.scheduler.send(
+            tgchat,
+            lambda: self.send_message(
+                tgchat, text, file=file_ or None, reply_to=reply_to
+            ),
+        )
+        if digest:
+            await self.mediacache.run(self.mediacache.add_tgmedia, digest, tgmsg)
+        return tgmsg
+
+    async def _prepare_dcmsg(
+        self, msgid: int
+    ) -> Optional[Tuple[DCMessage, str, Optional[str]]]:
+        """Get the message, the file to send to Telegram and the file's digest.
+
+        The message is prepared only once for all the Telegram chats it is sent to.
+        """
+        future = self._prepared.get(msgid)
+        if future is None:
+            future = asyncio.ensure_future(self._load_dcmsg(msgid))
+            self._prepared[msgid] = future
+            if len(self._prepared) > PREPARED_CACHE_SIZE:
+                self._prepared.popitem(last=False)
+        return await asyncio.shield(future)
+
+    async def _load_dcmsg(
+        self, msgid: int
+    ) -> Optional[Tuple[DCMessage, str, Optional[str]]]:
+        loop = asyncio.get_running_loop()
+        # in the sharded mode this is a call to the bot's process
+        dcmsg = await loop.run_in_executor(None, self.dc.get_message, msgid)
+        if dcmsg is None:
+            self.dcbot.logger.debug(f"Ignoring deleted message (id={msgid})")
+            return None
+        file_ = ""
+        if dcmsg.filename:
+            if dcmsg.filename.endswith(".aac"):
+                file_ = await self.media.audio(dcmsg.filename)
+            elif dcmsg.is_sticker:
+                file_ = dcmsg.filename
+            else:
+                limits = get_media_limits(self.dcbot, dcmsg.chat_id)
+                file_ = await self.media.optimize(dcmsg.filename, limits)
+        elif dcmsg.html:
+            file_ = await self.media.html(dcmsg.html)
+        if not dcmsg.text and not file_:
+            self.dcbot.logger.debug(f"Ignoring unsupported message (id={dcmsg.id})")
+            return None
+        digest = None
+        if file_:
+            digest = await loop.run_in_executor(None, file_digest, file_)
+        return dcmsg, file_, digest
+
+    def _send_to_dc_peers(
+        self, tgchat: int, tgmsg_id: int, dcmsgs: List[DCMessage]
+    ) -> None:
+        """Send the messages to the Delta Chat chats reached through the Telegram chat.
+
+        Runs in dc_executor, the copies are mapped to the Telegram message so
+        replies to them are relayed as replies everywhere.
+        """
+        for dcmsg in dcmsgs:
+            for chat_id, via in routes.get_dc_peers(dcmsg.chat_id).items():
+                if via != tgchat:
+                    continue
+                try:
+                    quote = None
+                    if dcmsg.quote_id:
+                        quote_tgmsg = self.msgmap.get_quoted_tgmsg(
+                            tgchat, dcmsg.quote_id
+                        )
+                        quote = quote_tgmsg and self.msgmap.get_quoted_dcmsg(
+                            tgchat, quote_tgmsg, chat_id
+                        )
+                    args = dict(
+                        text=dcmsg.text,
+                        html=dcmsg.html or None,
+                        viewtype="sticker" if dcmsg.is_sticker else None,
+                        filename=dcmsg.filename or None,
+                        sender=dcmsg.sender,
+                        quote=quote,
+                    )
+                    for copy_id in self.dc.send_messages(chat_id, [args]):
+                        self.msgmap.add(tgchat, tgmsg_id, chat_id, copy_id)
+                    RELAYED.inc("dc2dc", tgchat)
+                except Exception as ex:
+                    error(ex)
+                    self.dcbot.logger.exception(ex)
+
+    async def _coalesce(
+        self, tgchat: int, text: str, dcmsgs: List[DCMessage], seqs: List[int]
+    ) -> str:
+        """Merge the text-only messages queued for the chat after the given one.
+
+        If no message is queued, wait coalesce_window seconds for more messages.
+        The merged messages and their outbox entries are appended to dcmsgs and seqs.
+        """
+        if not self.dc2tg_dispatcher.depths().get(tgchat):
+            async with idle():
+                await asyncio.sleep(self.coalesce_window)
+
+        # only this lane's handler takes items from the lane, while the
+        # messages are fetched new items can only be appended
+        loop = asyncio.get_running_loop()
+        merged = set()
+        for seq, msgid in self.dc2tg_dispatcher.peek(tgchat):
+            dcmsg = await loop.run_in_executor(None, self.dc.get_message, msgid)
+            if (
+                not dcmsg
+                or dcmsg.filename
+                or dcmsg.html
+                or dcmsg.quote_id
+                or not dcmsg.text
+            ):
+                break
+            line = self._format_dcmsg(dcmsg)
+            if len(text) + len(line) + 1 > self.coalesce_size:
+                break
+            text += "\n" + line
+            dcmsgs.append(dcmsg)
+            seqs.append(seq)
+            merged.add(seq)
+
+        self.dc2tg_dispatcher.take(tgchat, lambda item: item[0] in merged)
+        return text
+
+    @staticmethod
+    def _format_dcmsg(dcmsg: DCMessage) -> str:
+        return f"**{dcmsg.sender}:** {dcmsg.text}"
+
+    async def tg2dc(self, event: events.NewMessage) -> None:
+        self.dcbot.logger.debug(
+            f"Got message (id={event.message.id}) from Telegram chat (id={event.chat_id})"
+        )
+        tgmsg = event.message
+        if tgmsg.text is None:
+            return
+        if not routes.get_dcchats(event.chat_id):
+            self.dcbot.logger.debug(
+                f"Ignoring message from Telegram chat (id={event.chat_id})"
+            )
+            return
+        buffer = self._backfilling.get(event.chat_id)
+        if buffer is not None:
+            buffer.append(tgmsg)
+        else:
+            self._receive(event.chat_id, tgmsg)
+
+    def _receive(self, tgchat: int, tgmsg: types.Message) -> None:
+        """Queue the message, album items are collected to be relayed together."""
+        album = self._albums.get(tgchat)
+        if album and album[0] != tgmsg.grouped_id:
+            self._flush_album(tgchat)
+            album = None
+        if tgmsg.grouped_id:
+            if album:
+                album[1].append(tgmsg)
+                if len(album[1]) >= ALBUM_MAX_SIZE:
+                    self._flush_album(tgchat)
+            else:
+                timer = asyncio.get_running_loop().call_later(
+                    ALBUM_WINDOW, self._flush_album, tgchat
+                )
+                self._albums[tgchat] = (tgmsg.grouped_id, [tgmsg], timer)
+        else:
+            self.tg2dc_dispatcher.submit(tgchat, (self._tg2dc, [tgmsg]))
+
+    def _flush_album(self, tgchat: int) -> None:
+        """Queue the album being collected in the given chat."""
+        _, tgmsgs, timer = self._albums.pop(tgchat)
+        timer.cancel()
+        self.tg2dc_dispatcher.submit(tgchat, (self._tg2dc, tgmsgs))
+
+    async def backfill(self) -> None:
+        """Relay the messages sent to the bridged chats while the bot was offline.
+
+        Chats are backfilled concurrently, up to max_downloads at once, their
+        live messages, edits and deletions are relayed after the missed
+        messages, skipping duplicates.
+        """
+        checkpoints = await self.msgmap.run(self.msgmap.get_checkpoints)
+        semaphore = asyncio.Semaphore(int(getdefault(self.dcbot, "max_downloads")))
+
+        async def backfill_chat(tgchat: int) -> None:
+            last = checkpoints[tgchat]
+            async with semaphore:
+                try:
+                    last = await self._backfill_chat(tgchat, last)
+                except Exception as ex:
+                    error(ex)
+                    self.dcbot.logger.exception(ex)
+            for update in self._backfilling.pop(tgchat):
+                if isinstance(update, tuple):  # edit or deletion
+                    self.tg2dc_dispatcher.submit(tgchat, update)
+                elif update.id > last:
+                    self._receive(tgchat, update)
+
+        await asyncio.gather(*map(backfill_chat, list(self._backfilling)))
+
+    async def _backfill_chat(self, tgchat: int, after: int) -> int:
+        """Queue the messages of the chat newer than ``after``, return the last one."""
+        count = 0
+        async for tgmsg in self._iter_missed(tgchat, after):
+            after = max(after, tgmsg.id)
+            if (
+                tgmsg.out
+                or tgmsg.text is None
+                or tgmsg.text.startswith(("/start", "/id"))
+                # relayed before restart
+                or await self.msgmap.run(self.msgmap.get_dcmsgs, tgchat, tgmsg.id)
+            ):
+                continue
+            self._receive(tgchat, tgmsg)
+            count += 1
+        self.dcbot.logger.debug(
+            f"Backfilled {count} messages from Telegram chat (id={tgchat})"
+        )
+        return after
+
+    async def _iter_missed(self, tgchat: int, after: int):
+        try:
+            async for tgmsg in self.iter_messages(
+                tgchat, min_id=after, reverse=True, limit=BACKFILL_LIMIT
+            ):
+                yield tgmsg
+            return
+        except BotMethodInvalidError:
+            pass
+        # bots can't read the history, the messages are fetched by ID until
+        # reaching the live messages or a page without messages
+        updates = self._backfilling[tgchat]
+        start = after + 1
+        while start <= after + BACKFILL_LIMIT:
+            ids = list(range(start, start + BACKFILL_PAGE_SIZE))
+            tgmsgs = [
+                tgmsg
+                for tgmsg in await self.get_messages(tgchat, ids=ids)
+                if isinstance(tgmsg, types.Message)
+            ]
+            for tgmsg in tgmsgs:
+                yield tgmsg
+            start += BACKFILL_PAGE_SIZE
+            live = next(
+                (update for update in updates if not isinstance(update, tuple)), None
+            )
+            if (live and live.id < start) or (not tgmsgs and not live):
+                break
+
+    async def tg_edit(self, event: events.MessageEdited) -> None:
+        tgmsg = event.message
+        # edits without edit date are updates of views, reactions, etc.
+        if tgmsg.text is None or not tgmsg.edit_date:
+            return
+        if routes.get_dcchats(event.chat_id):
+            self._submit_update(event.chat_id, (self._edit_tgmsg, tgmsg))
+
+    async def tg_delete(self, event: events.MessageDeleted) -> None:
+        if routes.get_dcchats(event.chat_id):
+            self._submit_update(event.chat_id, (self._delete_tgmsgs, event.deleted_ids))
+
+    def _submit_update(self, tgchat: int, item: tuple) -> None:
+        """Queue an edit or deletion, after the live messages buffered during backfill."""
+        buffer = self._backfilling.get(tgchat)
+        if buffer is not None:
+            buffer.append(item)
+        else:
+            self.tg2dc_dispatcher.submit(tgchat, item)
+
+    async def _edit_tgmsg(self, tgchat: int, tgmsg: types.Message) -> None:
+        """Relay the new text of the message to the chats that got a copy of it.
+
+        Delta Chat messages can't be edited, the new text is sent quoting the
+        copy, the copies in Telegram chats are edited.
+        """
+        if not await self.msgmap.run(self.msgmap.get_dcmsgs, tgchat, tgmsg.id):
+            self.dcbot.logger.debug(f"Ignoring edit of unknown message (id={tgmsg.id})")
+            return
+        sender = await self._get_tgmsg_sender(tgmsg)
+        await asyncio.get_running_loop().run_in_executor(
+            self.dc_executor, self._send_edit_to_dc, tgchat, tgmsg, sender
+        )
+        text = f"**{shorten_text(sender, 30)}:** {tgmsg.text}"
+        for peer, via in routes.get_tg_peers(tgchat).items():
+            dcmsg = await self.msgmap.run(self.msgmap.get_dcmsg, tgchat, tgmsg.id, via)
+            if dcmsg:
+                await self._to_peer(peer, self._edit_tg_peer, dcmsg, text)
+
+    async def _edit_tg_peer(self, peer: int, dcmsg: int, text: str) -> None:
+        """Edit the copy of the Delta Chat message in the Telegram chat."""
+        copy = await self.msgmap.run(self.msgmap.get_tgmsg, peer, dcmsg)
+        if not copy:
+            return
+        try:
+            await self.scheduler.send(
+                peer, partial(self.edit_message, peer, copy, text)
+            )
+            SYNCED.inc("edit", "tg")
+        except Exception as ex:
+            error(ex)
+            self.dcbot.logger.exception(ex)
+
+    def _send_edit_to_dc(self, tgchat: int, tgmsg: types.Message, sender: str) -> None:
+        for chat_id in routes.get_dcchats(tgchat):
+            dcmsg = self.msgmap.get_dcmsg(tgchat, tgmsg.id, chat_id)
+            if not dcmsg:
+                continue
+            try:
+                args = dict(text=f"✏️ {tgmsg.text}", sender=sender, quote=dcmsg)
+                self.dc.send_messages(chat_id, [args])
+                SYNCED.inc("edit", "dc")
+            except Exception as ex:
+                error(ex)
+                self.dcbot.logger.exception(ex)
+
+    async def _delete_tgmsgs(self, tgchat: int, tgmsg_ids: List[int]) -> None:
+        """Delete the copies of the messages.
+
+        Deletions queued in the chat's lane are merged so the copies are
+        deleted in a single request per chat.
+        """
+        tgmsg_ids = list(tgmsg_ids)
+
+        def accept(item: tuple) -> bool:
+            # bound methods are created on each access, compare their function
+            if getattr(item[0], "__func__", None) is not TelegramBot._delete_tgmsgs:
+                return False
+            tgmsg_ids.extend(item[1])
+            return True
+
+        self.tg2dc_dispatcher.take(tgchat, accept)
+        copies = [
+            await self.msgmap.run(self.msgmap.get_dcmsgs, tgchat, tgmsg_id)
+            for tgmsg_id in tgmsg_ids
+        ]
+        dcmsgs = [dcmsg for msgs in copies for dcmsg in msgs.values()]
+        if not dcmsgs:
+            return
+        await asyncio.get_running_loop().run_in_executor(
+            self.dc_executor, self.dc.delete_messages, dcmsgs
+        )
+        SYNCED.inc("delete", "dc", amount=len(dcmsgs))
+        for peer, via in routes.get_tg_peers(tgchat).items():
+            peer_dcmsgs = [msgs[via] for msgs in copies if via in msgs]
+            if peer_dcmsgs:
+                await self._to_peer(peer, self._delete_tg_peer, peer_dcmsgs)
+
+    async def _delete_tg_peer(self, peer: int, dcmsgs: List[int]) -> None:
+        """Delete the copies of the Delta Chat messages in the Telegram chat."""
+        peer_ids = []
+        for dcmsg in dcmsgs:
+            copy = await self.msgmap.run(self.msgmap.get_tgmsg, peer, dcmsg)
+            if copy:
+                peer_ids.append(copy)
+        if not peer_ids:
+            return
+        try:
+            await self.scheduler.send(
+                peer, partial(self.delete_messages, peer, peer_ids)
+            )
+            SYNCED.inc("delete", "tg", amount=len(peer_ids))
+        except Exception as ex:
+            error(ex)
+            self.dcbot.logger.exception(ex)
+
+    async def _tg2dc(self, tgchat: int, tgmsgs: List[types.Message]) -> None:
+        with TemporaryDirectory() as tempdir:
+            # album items are downloaded in parallel
+            prepared = await asyncio.gather(
+                *(self._prepare_tgmsg(tgmsg, tempdir) for tgmsg in tgmsgs)
+            )
+            items = [item for item in prepared if item]
+            try:
+                if items:
+                    await self._relay_tgmsgs(tgchat, items)
+            finally:
+                # saved with the mappings of the copies
+                await self.msgmap.run(
+                    self.msgmap.set_checkpoint,
+                    tgchat,
+                    max(tgmsg.id for tgmsg in tgmsgs),
+                )
+
+    async def _relay_tgmsgs(self, tgchat: int, items: List[tuple]) -> None:
+        files = await self._optimize_for_dc(tgchat, items)
+        copies = await asyncio.get_running_loop().run_in_executor(
+            self.dc_executor, self._send_to_dc, tgchat, items, files
+        )
+        # Telegram chats sharing a Delta Chat chat get the same downloaded files
+        await asyncio.gather(
+            *(
+                self._relay_to_tg_peer(tgchat, peer, via, items, copies)
+                for peer, via in routes.get_tg_peers(tgchat).items()
+            )
+        )
+
+    async def _optimize_for_dc(
+        self, tgchat: int, items: List[tuple]
+    ) -> Dict[int, List[Optional[str]]]:
+        """Get the files of the items within the media limits of every Delta Chat chat.
+
+        Files are optimized once for all the chats with the same limits.
+        """
+
+        async def optimize(args: dict, limits: MediaLimits) -> Optional[str]:
+            filename = args.get("filename")
+            if not filename or args.get("viewtype") == "sticker":
+                return filename
+            return await self.media.optimize(filename, limits)
+
+        if not any(args.get("filename") for _, _, args in items):
+            return {}
+        optimized: Dict[MediaLimits, List[Optional[str]]] = {}
+        files = {}
+        for chat_id in routes.get_dcchats(tgchat):
+            limits = get_media_limits(self.dcbot, chat_id)
+            if limits not in optimized:
+                optimized[limits] = await asyncio.gather(
+                    *(optimize(args, limits) for _, _, args in items)
+                )
+            files[chat_id] = optimized[limits]
+        return files
+
+    async def _relay_to_tg_peer(
+        self,
+        tgchat: int,
+        peer: int,
+        via: int,
+        items: List[tuple],
+        copies: Dict[int, List[int]],
+    ) -> None:
+        """Send the messages to a Telegram chat sharing the Delta Chat chat ``via``.
+
+        The copies are mapped to the copies sent to the Delta Chat chats bridged
+        with both Telegram chats.
+        """
+        messages = []
+        for _, reply_to, args in items:
+            quote = None
+            if reply_to:
+                quote = await self.msgmap.run(
+                    self.msgmap.get_quoted_dcmsg, tgchat, reply_to, via
+                )
+            messages.append((quote, args))
+        shared = {
+            chat_id: copies[chat_id]
+            for chat_id in routes.get_dcchats(peer) & copies.keys()
+        }
+        folder = None
+        if not self._owns(peer):
+            # the downloaded files are removed once relayed, the other worker gets links
+            messages, folder = await asyncio.get_running_loop().run_in_executor(
+                None, self._share_files, messages
+            )
+        await self._to_peer(peer, self._send_to_tg_peer, messages, shared, folder)
+
+    def _share_files(self, messages: List[tuple]) -> Tuple[List[tuple], str]:
+        """Link the files of the messages in a new folder of ``peer_dir``."""
+        folder = mkdtemp(dir=self.peer_dir)
+        shared = []
+        for index, (quote, args) in enumerate(messages):
+            filename = args.get("filename")
+            if filename:
+                # one folder per message to keep the file names
+                path = os.path.join(folder, str(index), os.path.basename(filename))
+                os.makedirs(os.path.dirname(path))
+                try:
+                    os.link(filename, path)
+                except OSError:
+                    shutil.copyfile(filename, path)
+                args = dict(args, filename=path)
+            shared.append((quote, args))
+        return shared, folder
+
+    async def _send_to_tg_peer(
+        self,
+        peer: int,
+        messages: List[tuple],
+        copies: Dict[int, List[int]],
+        folder: Optional[str] = None,
+    ) -> None:
+        """Send the messages to the Telegram chat, mapping them to the given copies.
+
+        :param messages: list of (ID of the quoted Delta Chat message, reply arguments)
+        :param copies: the IDs of the copies in each Delta Chat chat
+        :param folder: folder of the files shared by another shard, removed once sent
+        """
+        try:
+            for index, (quote_dcmsg, args) in enumerate(messages):
+                try:
+                    quote = quote_dcmsg and await self.msgmap.run(
+                        self.msgmap.get_quoted_tgmsg, peer, quote_dcmsg
+                    )
+                    text = (
+                        f"**{shorten_text(args['sender'], 30)}:** {args['text'] or ''}"
+                    )
+                    tgmsg = await self.scheduler.send(
+                        peer,
+                        partial(
+                            self.send_message,
+                            peer,
+                            text,
+                            file=args.get("filename"),
+                            reply_to=quote,
+                        ),
+                    )
+                    for chat_id, dcmsgs in copies.items():
+                        await self.msgmap.run(
+                            self.msgmap.add, peer, tgmsg.id, chat_id, dcmsgs[index]
+                        )
+                    RELAYED.inc("tg2tg", peer)
+                except Exception as ex:
+                    error(ex)
+                    self.dcbot.logger.exception(ex)
+        finally:
+            if folder:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, partial(shutil.rmtree, folder, ignore_errors=True)
+                )
+
+    async def _prepare_tgmsg(
+        self, tgmsg: types.Message, tempdir: str
+    ) -> Optional[tuple]:
+        """Get the (message ID, replied message ID, reply arguments) of the message."""
+        args = dict(text=tgmsg.text, sender=await self._get_tgmsg_sender(tgmsg))
+        if tgmsg.file:
+            # one folder per message to avoid name clashes between album items
+            folder = os.path.join(tempdir, str(tgmsg.id))
+            os.makedirs(folder)
+            args["filename"] = await self._download(tgmsg, folder)
+            if args["filename"] and tgmsg.sticker:
+                args["viewtype"] = "sticker"
+        if not args.get("text") and not args.get("filename"):
+            return None
+        reply_to = tgmsg.reply_to and tgmsg.reply_to.reply_to_msg_id
+        return (tgmsg.id, reply_to, args)
+
+    async def _get_tgmsg_sender(self, tgmsg: types.Message) -> str:
+        name = self.tg_names.get(tgmsg.sender_id)
+        if name is not None:
+            NAME_LOOKUPS.inc("tg", "hit")
+            return name
+        NAME_LOOKUPS.inc("tg", "miss")
+        sender = tgmsg.sender
+        if sender is None and tgmsg.sender_id is not None:
+            try:
+                sender = await tgmsg.get_sender()
+            except Exception as ex:
+                error(ex)
+                self.dcbot.logger.exception(ex)
+        if sender is None:
+            return "[UNKNOWN SENDER]"
+        if hasattr(sender, "first_name"):
+            name = " ".join((sender.first_name or "", sender.last_name or "")).strip()
+        else:
+            name = getattr(sender, "title", "")
+        if tgmsg.sender_id is not None:
+            self.tg_names.set(tgmsg.sender_id, name)
+        return name
+
+    async def _download(self, tgmsg: types.Message, folder: str) -> Optional[str]:
+        """Download the message's media if it is not bigger than the size limits.
+
+        Media downloaded before is taken from the media cache.
+        """
+        if tgmsg.photo:
+            key = f"photo-{tgmsg.photo.id}"
+        elif tgmsg.document:
+            key = f"document-{tgmsg.document.id}"
+        else:
+            key = ""
+        path: Optional[str] = None
+        if key:
+            path = await self.mediacache.run(self.mediacache.get_file, key)
+        if path:
+            return path
+        with MEDIA_TIME.time("download"):
+            path = await self._download_media(tgmsg, folder)
+        if path:
+            MEDIA_BYTES.inc("download", amount=os.path.getsize(path))
+            if key:
+                # the file may be copied and old files removed, off the loop
+                await self.mediacache.run(self.mediacache.add_file, key, path)
+        return path
+
+    async def _download_media(self, tgmsg: types.Message, folder: str) -> Optional[str]:
+        max_size = int(getdefault(self.dcbot, "max_size"))
+        size = tgmsg.file.size
+        if size is not None and size <= max_size:
+            return await tgmsg.download_media(folder)
+
+        # files of unknown size or bigger than max_size are streamed to disk,
+        # aborting as soon as they exceed the limit
+        max_size = max(max_size, int(getdefault(self.dcbot, "stream_max_size")))
+        if size is not None and size > max_size:
+            self.dcbot.logger.debug(
+                f"Ignoring media of message (id={tgmsg.id}), size exceeds the limit"
+            )
+            return None
+        # the name comes from the sender, keep only its last component
+        name = os.path.basename((tgmsg.file.name or "").replace("\\", "/"))
+        if name in ("", ".", ".."):
+            name = f"file{tgmsg.file.ext or ''}"
+        if size is not None:
+            # big files are saved directly in the blob folder to avoid copying them
+            folder = self.dc.get_blobdir()
+            name = f"{tgmsg.chat_id}-{tgmsg.id}-{name}"
+        path = os.path.join(folder, name)
+        if await download(self, tgmsg.media, path, max_size, self.dcbot.logger):
+            return path
+        self.dcbot.logger.debug(
+            f"Ignoring media of message (id={tgmsg.id}), size exceeds the limit"
+        )
+        return None
+
+    def _send_to_dc(
+        self,
+        tgchat: int,
+        items: List[tuple],
+        files: Dict[int, List[Optional[str]]] = None,
+    ) -> Dict[int, List[int]]:
+        """Send the messages to the bridged Delta Chat chats, runs in dc_executor.
+
+        :param items: list of (Telegram message ID, replied message ID, reply arguments)
+        :param files: files of the items to send to each chat instead of the
+                      downloaded ones
+        :returns: the IDs of the copies sent to each Delta Chat chat
+        """
+        copies = {}
+        for chat_id in routes.get_dcchats(tgchat):
+            try:
+                messages = []
+                for index, (_, reply_to, args) in enumerate(items):
+                    quote = None
+                    if reply_to:
+                        quote = self.msgmap.get_quoted_dcmsg(tgchat, reply_to, chat_id)
+                    message = dict(args, quote=quote)
+                    if files and chat_id in files and args.get("filename"):
+                        message["filename"] = files[chat_id][index]
+                    messages.append(message)
+                dcmsgs = self.dc.send_messages(chat_id, messages)
+                for (tgmsg_id, _, _), dcmsg in zip(items, dcmsgs):
+                    self.msgmap.add(tgchat, tgmsg_id, chat_id, dcmsg)
+                copies[chat_id] = dcmsgs
+                RELAYED.inc("tg2dc", tgchat, amount=len(dcmsgs))
+            except Exception as ex:
+                error(ex)
+                self.dcbot.logger.exception(ex)
+        return copies
@@ -3,31 +3,340 @@
 import asyncio
 import os
 import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from functools import wraps
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
 
 from simplebot import DeltaBot
 
+from .metrics import QUEUE_WAIT, error
+
 _scope = __name__.split(".", maxsplit=1)[0]
+T = TypeVar("T")
+
+
+class AsyncQueue:
+    """Queue to pass items from threads to an asyncio event loop.
+
+    Consumers awaiting on the queue are woken up by the producers with
+    ``call_soon_threadsafe()`` instead of polling. If ``maxsize`` is greater
+    than zero, the queue is bounded and producers block (or wait, in the
+    async case) until there is free space.
+    """
+
+    def __init__(self, maxsize: int = 0) -> None:
+        self.maxsize = maxsize
+        self._items: deque = deque()
+        self._mutex = threading.Lock()
+        self._not_full = threading.Condition(self._mutex)
+        self._getters: deque = deque()
+        self._putters: deque = deque()
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    def put(self, item, block: bool = True, timeout: float = None) -> None:
+        """Put an item in the queue from any thread except the consumer's loop."""
+        with self._not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self.full():
+                        raise queue.Full
+                elif not self._not_full.wait_for(
+                    lambda: not self.full(), timeout=timeout
+                ):
+                    raise queue.Full
+            self._put(item)
 
+    def put_nowait(self, item) -> None:
+        self.put(item, block=False)
 
-class AsyncQueue(queue.Queue):
-    def __init__(self, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
-        self.timeout = 0.02
+    def get_nowait(self):
+        with self._mutex:
+            if not self._items:
+                raise queue.Empty
+            return self._get()
 
     async def aget(self):
+        loop = asyncio.get_running_loop()
         while True:
-            try:
-                return self.get_nowait()
-            except queue.Empty:
-                await asyncio.sleep(self.timeout)
+            with self._mutex:
+                if self._items:
+                    return self._get()
+                waiter = loop.create_future()
+                self._getters.append(waiter)
+            await self._wait(waiter, self._getters)
 
-    async def aput(self, data):
+    async def aput(self, item) -> None:
+        loop = asyncio.get_running_loop()
         while True:
-            try:
-                return self.put_nowait(data)
-            except queue.Full:
-                await asyncio.sleep(self.timeout)
+            with self._mutex:
+                if not self.full():
+                    self._put(item)
+                    return
+                waiter = loop.create_future()
+                self._putters.append(waiter)
+            await self._wait(waiter, self._putters)
+
+    def _put(self, item) -> None:
+        self._items.append(item)
+        _wakeup_next(self._getters)
+
+    def _get(self):
+        item = self._items.popleft()
+        self._not_full.notify()
+        _wakeup_next(self._putters)
+        return item
+
+    async def _wait(self, waiter: asyncio.Future, waiters: deque) -> None:
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._mutex:
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    # already woken up, pass the turn to the next waiter
+                    _wakeup_next(waiters)
+            raise
+
+
+def _wakeup_next(waiters: deque) -> None:
+    while waiters:
+        waiter = waiters.popleft()
+        try:
+            waiter.get_loop().call_soon_threadsafe(_set_result, waiter)
+            return
+        except RuntimeError:  # the loop is closed
+            continue
+
+
+def _set_result(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class _LaneSlot:
+    """Worker slot of a ChatDispatcher lane, given back while the lane is idle."""
+
+    def __init__(self, semaphore: asyncio.Semaphore) -> None:
+        self.semaphore = semaphore
+        self.held = False
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            if not self.held:
+                await self.semaphore.acquire()
+                self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+_lane_slot: ContextVar[Optional[_LaneSlot]] = ContextVar("lane_slot", default=None)
+
+
+@asynccontextmanager
+async def idle() -> AsyncIterator[None]:
+    """Give back the worker slot of the current ChatDispatcher lane while waiting.
+
+    Other lanes can use the slot until the block ends. Outside of a lane this
+    does nothing.
+    """
+    slot = _lane_slot.get()
+    if slot is None:
+        yield
+        return
+    slot.waiting += 1
+    slot.release()
+    try:
+        yield
+    finally:
+        slot.waiting -= 1
+        if not slot.waiting:
+            await slot.acquire()
+
+
+class ChatDispatcher:  # noqa
+    """Dispatch items to a worker lane per chat.
+
+    Items of the same chat are handled in order, one at a time, while items of
+    different chats are handled concurrently, up to ``max_workers`` at once.
+    Handlers waiting inside ``idle()`` don't count towards that limit.
+    The time items wait in the lanes is recorded in metrics under ``name``.
+    If ``maxsize`` is greater than zero, producers can use ``wait_for_room()``
+    to wait until fewer than ``maxsize`` items are waiting.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[int, Any], Awaitable],
+        max_workers: int,
+        logger,
+        name: str = "",
+        maxsize: int = 0,
+    ) -> None:
+        self.handler = handler
+        self.logger = logger
+        self.name = name
+        self.maxsize = maxsize
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._lanes: Dict[int, deque] = {}
+        self._tasks: set = set()
+        # items waiting in all the lanes, read from other threads by the metrics
+        self._pending = 0
+        self._room: Optional[asyncio.Future] = None
+
+    def submit(self, chat_id: int, item: Any) -> None:
+        """Queue item in the chat's lane, must be called from the event loop."""
+        lane = self._lanes.get(chat_id)
+        item = (time.monotonic(), item)
+        self._pending += 1
+        if lane is None:
+            self._lanes[chat_id] = lane = deque([item])
+            task = asyncio.ensure_future(self._run_lane(chat_id, lane))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            lane.append(item)
+
+    def take(self, chat_id: int, accept: Callable[[Any], bool]) -> List[Any]:
+        """Remove and return the items at the front of the chat's lane while accept(item) is true."""
+        lane = self._lanes.get(chat_id)
+        taken = []
+        while lane and accept(lane[0][1]):
+            queued, item = lane.popleft()
+            self._dequeued()
+            QUEUE_WAIT.observe(time.monotonic() - queued, self.name)
+            taken.append(item)
+        return taken
+
+    def peek(self, chat_id: int) -> List[Any]:
+        """Get the items waiting in the chat's lane, without removing them."""
+        return [item for _, item in self._lanes.get(chat_id, ())]
+
+    def depths(self) -> Dict[int, int]:
+        """Get the number of items waiting in each active lane, safe to call from any thread."""
+        # copying a dict is atomic, iterating it while the loop changes it isn't
+        lanes = self._lanes.copy()
+        return {chat_id: len(lane) for chat_id, lane in lanes.items()}
+
+    def qsize(self) -> int:
+        """Get the number of items waiting in all the lanes, safe to call from any thread."""
+        return self._pending
+
+    async def wait_for_room(self) -> None:
+        """Wait until fewer than maxsize items are waiting in the lanes."""
+        while 0 < self.maxsize <= self._pending:
+            if self._room is None or self._room.done():
+                self._room = asyncio.get_running_loop().create_future()
+            await self._room
+
+    def _dequeued(self) -> None:
+        self._pending -= 1
+        if self._room and not self._room.done() and self._pending < self.maxsize:
+            self._room.set_result(None)
+
+    async def _run_lane(self, chat_id: int, lane: deque) -> None:
+        slot = _LaneSlot(self._semaphore)
+        _lane_slot.set(slot)
+        try:
+            while lane:
+                await slot.acquire()
+                try:
+                    queued, item = lane.popleft()
+                    self._dequeued()
+                    QUEUE_WAIT.observe(time.monotonic() - queued, self.name)
+                    await self.handler(chat_id, item)
+                except Exception as ex:
+                    error(ex)
+                    self.logger.exception(ex)
+                finally:
+                    slot.release()
+        finally:
+            del self._lanes[chat_id]
+
+
+class TTLCache:
+    """Thread-safe LRU cache of up to ``maxsize`` entries that expire ``ttl`` seconds after set."""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (expiration time, value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Repository:  # noqa
+    """Base class of the data access objects, also of the stores using sqlite3 directly.
+
+    Methods are blocking, they can be called from any thread, from an event
+    loop they must be awaited with ``run()`` so the loop is not blocked on
+    database I/O or on the locks held by other threads.
+    """
+
+    _executor = ThreadPoolExecutor(4, thread_name_prefix="db")
+
+    async def run(self, method: Callable[..., T], *args) -> T:
+        """Run a method of the repository in the database threads."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, method, *args
+        )
 
 
 def sync(func):
@@ -46,15 +355,84 @@ def getdefault(bot: DeltaBot, key: str, value: str = None) -> str:
     return val
 
 
-def set_config(bot: DeltaBot, key: str, value: str = None) -> None:
+# functions called with (key, value) when a setting changes
+config_listeners: List[Callable[[str, Optional[str]], None]] = []
+
+
+def set_config(bot: DeltaBot, key: str, value: Optional[str] = None) -> None:
     bot.set(key, value, scope=_scope)
+    # settings change rarely, forget everything derived from them
+    _media_limits.clear()
+    for listener in config_listeners:
+        listener(key, value)
+
+
+def get_settings(bot: DeltaBot) -> Dict[str, str]:
+    """Get all the settings of the plugin."""
+    return dict(bot.list_settings(scope=_scope))
+
+
+class MediaLimits(NamedTuple):
+    """Limits of the media relayed to and from a Delta Chat chat, 0 disables a limit."""
+
+    image_size: int  # maximum width and height of images, in pixels
+    image_quality: int  # JPEG quality of the shrunk images
+    video_bitrate: int  # bitrate of the transcoded videos, in kbps
+
+    @classmethod
+    def parse(cls, text: str) -> "MediaLimits":
+        """Parse limits like "1280 75 500", raise ValueError if invalid."""
+        values = [int(value) for value in text.split()]
+        if len(values) != 3 or min(values) < 0 or not 1 <= values[1] <= 95:
+            raise ValueError(f"Invalid media limits: {text!r}")
+        return cls(*values)
+
+    def __str__(self) -> str:
+        return " ".join(map(str, self))
 
 
-def get_session_path(bot: DeltaBot) -> str:
+# parsed limits of the chats: {Delta Chat chat ID: limits}, cleared by set_config()
+_media_limits: Dict[int, MediaLimits] = {}
+
+
+def get_media_limits(bot: DeltaBot, chat_id: int) -> MediaLimits:
+    """Get the media limits of the Delta Chat chat, or the default ones.
+
+    Invalid settings are ignored, if the default limits are invalid too, media
+    is relayed without limits.
+    """
+    limits = _media_limits.get(chat_id)
+    if limits is None:
+        defaults = " ".join(
+            getdefault(bot, key) or ""
+            for key in ("image_size", "image_quality", "video_bitrate")
+        )
+        for value in (getdefault(bot, f"media_limits_{chat_id}"), defaults):
+            if not value:
+                continue
+            try:
+                limits = MediaLimits.parse(value)
+                break
+            except ValueError as ex:
+                bot.logger.warning(str(ex))
+        else:
+            limits = MediaLimits(0, 85, 0)
+        _media_limits[chat_id] = limits
+    return limits
+
+
+def get_session_path(bot: DeltaBot, shard: int = None) -> str:
     path = os.path.join(os.path.dirname(bot.account.db_path), _scope)
     if not os.path.exists(path):
         os.makedirs(path)
-    return os.path.join(path, "telegram.session")
+    if shard is None:
+        return os.path.join(path, "telegram.session")
+    return os.path.join(path, f"telegram-{shard}.session")
+
+
+def get_shard(chat_id: int, shards: int) -> int:
+    """Get the shard the chat belongs to, the same in every process."""
+    return zlib.crc32(str(chat_id).encode()) % shards
 
 
 def shorten_text(text: str, width: int, placeholder: str = "…") -> str:
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+
+# modules only needed when the bot runs or converts media
+HEAVY_MODULES = ("telethon", "sqlalchemy", "pydub", "cachelib")
+
+
+def test_import_time() -> None:
+    code = (
+        "import sys, simplebot_tggroups;"
+        f"print(*(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert result.stdout.split() == []
+
+    # last line of the report is the plugin, with the cumulative time in microseconds
+    total = next(
+        int(line.split("|")[1])
+        for line in reversed(result.stderr.splitlines())
+        if line.rstrip().endswith("| simplebot_tggroups")
+    )
+    print(f"\nimport simplebot_tggroups: {total / 1000:.1f}ms")
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from simplebot_tggroups.ipc import (
+    RemoteDeltaChat,
+    RemoteOutbox,
+    WorkerBot,
+    WorkerChannel,
+)
+from simplebot_tggroups.routing import routes
+from simplebot_tggroups.tgbot import TelegramBot
+from simplebot_tggroups.util import get_shard, getdefault, set_config
+
+
+class FakeOutbox:
+    def __init__(self) -> None:
+        self.replay_until = 0
+        self.done_seqs: list = []
+
+    def done(self, seqs) -> None:
+        self.done_seqs.extend(seqs)
+
+
+class FakeDeltaChat:
+    def __init__(self, bot) -> None:
+        self.bot = bot
+
+    def get_message(self, msgid: int) -> dict:
+        return {"id": msgid}
+
+    def unbridge(self, tgchat: int) -> None:
+        raise ValueError(tgchat)
+
+
+def test_channel(mocker, monkeypatch) -> None:
+    conn, worker_conn = multiprocessing.Pipe()
+    outbox = FakeOutbox()
+    channel = WorkerChannel(conn, FakeDeltaChat(mocker.bot), outbox, 1)
+    dc = RemoteDeltaChat(worker_conn, "/blobdir")
+    settings: list = []
+    dc.config_handlers.append(lambda key, value: settings.append((key, value)))
+
+    assert dc.get_message(5) == {"id": 5}
+    assert dc.get_blobdir() == "/blobdir"
+    with pytest.raises(RuntimeError, match="ValueError"):
+        dc.unbridge(-10)
+
+    channel.send("route", "add", 1, -10)
+    channel.send("config", "max_size", "10")
+    assert channel.credits.acquire(blocking=False)
+    channel.send("dc2tg", 1, -10, 5)
+    assert not channel.credits.acquire(blocking=False)  # the worker is full
+    journal = RemoteOutbox(dc, 0)
+    assert asyncio.run(asyncio.wait_for(journal.get(), 5)) == (1, -10, 5)
+    assert -10 in routes.get_tgchats(1)
+    assert settings == [("max_size", "10")]
+    routes.remove(1, -10)
+
+    journal.done([1])
+    dc.get_message(6)  # the pipe is ordered, "done" was handled before the call
+    assert outbox.done_seqs == [1]
+    assert channel.credits.acquire(blocking=False)  # room again once taken
+
+    # workers save their state before exiting
+    calls: list = []
+    dc.exit_handlers.append(lambda: calls.append("saved"))
+    monkeypatch.setattr(os, "_exit", calls.append)
+    channel.stop()
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert calls == ["saved", 0]
+
+
+def test_peer_jobs(mocker, tmp_path) -> None:
+    set_config(mocker.bot, "api_id", "1")
+    set_config(mocker.bot, "api_hash", "0" * 32)
+    conn, worker_conn = multiprocessing.Pipe()
+    channel = WorkerChannel(conn, FakeDeltaChat(mocker.bot), FakeOutbox(), 1)
+    jobs: list = []
+    channel.peers = [channel, SimpleNamespace(send=lambda *job: jobs.append(job))]
+    dc = RemoteDeltaChat(worker_conn, str(tmp_path))
+    tgbot = TelegramBot(mocker.bot, dc=dc, shard=0, shards=2)
+    peer = next(chat for chat in range(-100, -200, -1) if get_shard(chat, 2) == 1)
+    routes.add(1, peer)
+    file_ = tmp_path / "photo.jpg"
+    file_.write_bytes(b"data")
+    items = [(5, None, dict(text="hi", sender="Bob", filename=str(file_)))]
+
+    # messages for chats of other shards are relayed to the worker of the chat
+    asyncio.run(tgbot._relay_to_tg_peer(-10, peer, 1, items, {1: [7], 2: [8]}))
+    deadline = time.monotonic() + 5
+    while not jobs and time.monotonic() < deadline:
+        time.sleep(0.01)
+    ((_, method, chat, args),) = jobs
+    assert (method, chat) == ("_send_to_tg_peer", peer)
+    messages, copies, folder = args
+    assert copies == {1: [7]}
+    path = messages[0][1]["filename"]
+    assert path.startswith(folder) and open(path, "rb").read() == b"data"
+
+    sent: list = []
+
+    async def send_message(chat_id: int, text: str, **kwargs) -> SimpleNamespace:
+        sent.append((chat_id, text, kwargs["file"]))
+        return SimpleNamespace(id=50)
+
+    tgbot.send_message = send_message
+    asyncio.run(tgbot._run_peer_job(peer, (method, args)))
+    assert sent == [(peer, "**Bob:** hi", path)]
+    assert tgbot.msgmap.get_tgmsg(peer, 7) == 50
+    assert not os.path.exists(folder)  # the shared files are removed once sent
+    routes.remove(1, peer)
+    with pytest.raises(ValueError):
+        asyncio.run(tgbot._run_peer_job(peer, ("delete_messages", ([50],))))
+
+
+def test_worker_bot() -> None:
+    bot = WorkerBot({"max_size": "5"}, "/bot.db", logging.getLogger(__name__))
+    assert getdefault(bot, "max_size") == "5"
+    # changes pushed by the bot's process update the snapshot
+    set_config(bot, "max_size", "10")
+    set_config(bot, "metrics_file", None)
+    assert bot.settings == {"max_size": "10"}
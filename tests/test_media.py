@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+from types import SimpleNamespace
+
+from PIL import Image
+from telethon import types
+
+from simplebot_tggroups.media import MediaCache, MediaPreparer
+from simplebot_tggroups.util import MediaLimits
+
+
+class TestMediaPreparer:
+    def test_html(self, tmp_path) -> None:
+        media = MediaPreparer(str(tmp_path), logging.getLogger(__name__))
+
+        async def prepare() -> list:
+            return await asyncio.gather(
+                media.html("<b>hi</b>"), media.html("<b>hi</b>")
+            )
+
+        path1, path2 = asyncio.run(prepare())
+        assert path1 == path2
+        assert path1.endswith(".html")
+        with open(path1, encoding="utf-8") as file:
+            assert file.read() == "<b>hi</b>"
+
+    def test_audio_fallback(self, tmp_path) -> None:
+        media = MediaPreparer(str(tmp_path / "cache"), logging.getLogger(__name__))
+        filename = str(tmp_path / "voice.aac")
+        with open(filename, "wb") as file:
+            file.write(b"not really audio")
+
+        assert asyncio.run(media.audio(filename)) == filename
+        assert not os.listdir(media.cache_dir)
+
+    def test_optimize_image(self, tmp_path) -> None:
+        media = MediaPreparer(str(tmp_path / "cache"), logging.getLogger(__name__))
+        filename = str(tmp_path / "photo.png")
+        Image.effect_noise((800, 600), 50).convert("RGB").save(filename)
+
+        path = asyncio.run(media.optimize(filename, MediaLimits(400, 75, 0)))
+        assert path.endswith(".jpg")
+        assert os.path.getsize(path) < os.path.getsize(filename)
+        with Image.open(path) as img:
+            assert img.size == (400, 300)
+        # disabled limit or unsupported files are not changed
+        assert asyncio.run(media.optimize(filename, MediaLimits(0, 75, 0))) == filename
+        Image.new("RGBA", (800, 600)).save(filename)
+        assert (
+            asyncio.run(media.optimize(filename, MediaLimits(400, 75, 0))) == filename
+        )
+
+
+class TestMediaCache:
+    def test_tgmedia(self, tmp_path) -> None:
+        cache = MediaCache(str(tmp_path / "cache.db"), str(tmp_path / "files"), 10)
+        assert cache.get_tgmedia("digest") is None
+
+        document = types.Document(1, 2, b"ref", None, "text/plain", 3, 4, [])
+        cache.add_tgmedia("digest", SimpleNamespace(photo=None, document=document))
+        assert cache.get_tgmedia("digest") == types.InputDocument(1, 2, b"ref")
+
+        cache.forget_tgmedia("digest")
+        assert cache.get_tgmedia("digest") is None
+
+    def test_files_eviction(self, tmp_path) -> None:
+        cache = MediaCache(str(tmp_path / "cache.db"), str(tmp_path / "files"), 10)
+        for name in ("a", "b", "c"):
+            (tmp_path / name).write_bytes(b"12345")
+
+        path_a = cache.add_file("a", str(tmp_path / "a"))
+        with open(path_a, "rb") as file:
+            assert file.read() == b"12345"
+        assert cache.add_file("b", str(tmp_path / "b"))
+        assert cache.get_file("a") == path_a  # "b" is now the least recently used
+        cache.add_file("c", str(tmp_path / "c"))
+        assert cache.get_file("b") is None
+        assert cache.get_file("a") == path_a
+        assert cache.get_file("c")
+
+        (tmp_path / "big").write_bytes(b"12345678901")
+        assert cache.add_file("big", str(tmp_path / "big")) is None
@@ -0,0 +1,27 @@
+from simplebot_tggroups.metrics import Registry
+
+
+class TestMetrics:
+    def test_render(self) -> None:
+        registry = Registry()
+        counter = registry.counter("test_total", "A counter", ("chat",))
+        gauge = registry.gauge("test_depth", "A gauge", ("queue",))
+        histogram = registry.histogram("test_seconds", "A histogram")
+        counter.inc(-100)
+        counter.inc(-100, amount=2)
+        gauge.collect_with(lambda: {("outbox",): 5})
+        gauge.collect_with(lambda: {}.popitem())  # errors don't break rendering
+        histogram.observe(0.2)
+        histogram.observe(100)
+
+        assert counter.get(-100) == 3
+        assert histogram.get_count() == 2
+        text = registry.render()
+        assert "# TYPE test_total counter\n" in text
+        assert 'test_total{chat="-100"} 3\n' in text
+        assert 'test_depth{queue="outbox"} 5\n' in text
+        assert 'test_seconds_bucket{le="0.1"} 0\n' in text
+        assert 'test_seconds_bucket{le="0.25"} 1\n' in text
+        assert 'test_seconds_bucket{le="+Inf"} 2\n' in text
+        assert "test_seconds_sum 100.2\n" in text
+        assert "test_seconds_count 2\n" in text
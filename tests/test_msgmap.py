@@ -0,0 +1,90 @@
+import os
+
+from cachelib import FileSystemCache
+
+from simplebot_tggroups.metrics import REPLY_LOOKUPS
+from simplebot_tggroups.msgmap import UNKNOWN_CHAT, MessageMap
+
+
+class TestMessageMap:
+    def test_mapping(self, tmp_path) -> None:
+        path = str(tmp_path / "msgmap.db")
+        msgmap = MessageMap(path, batch_size=2, cache_size=1)
+        msgmap.add(-100, 1, 10, 101)
+        msgmap.add(-100, 1, 11, 111)
+        msgmap.add(-200, 5, 10, 102)
+        assert msgmap.get_tgmsg(-100, 101) == 1
+        assert msgmap.get_tgmsg(-100, 102) is None
+        assert msgmap.get_dcmsgs(-100, 1) == {10: 101, 11: 111}
+        assert msgmap.get_dcmsg(-100, 1, 11) == 111
+        assert msgmap.get_dcmsg(-100, 1, 12) is None
+        msgmap.close()
+
+        msgmap = MessageMap(path)
+        assert msgmap.get_dcmsg(-200, 5, 10) == 102
+        msgmap.close()
+
+    def test_reply_lookups(self, tmp_path) -> None:
+        msgmap = MessageMap(str(tmp_path / "msgmap.db"), cache_size=1)
+        msgmap.add(-100, 1, 10, 101)
+        hits, misses = REPLY_LOOKUPS.get("hit"), REPLY_LOOKUPS.get("miss")
+        assert msgmap.get_tgmsg(-100, 101) == 1
+        assert msgmap.get_dcmsgs(-100, 1) == {10: 101}
+        # only the lookups of quoted messages are counted
+        assert (REPLY_LOOKUPS.get("hit"), REPLY_LOOKUPS.get("miss")) == (hits, misses)
+        assert msgmap.get_quoted_tgmsg(-100, 101) == 1
+        assert msgmap.get_quoted_dcmsg(-100, 2, 10) is None
+        assert REPLY_LOOKUPS.get("hit") == hits + 1
+        assert REPLY_LOOKUPS.get("miss") == misses + 1
+        msgmap.close()
+
+    def test_checkpoints(self, tmp_path) -> None:
+        path = str(tmp_path / "msgmap.db")
+        msgmap = MessageMap(path)
+        msgmap.set_checkpoint(-100, 5)
+        msgmap.set_checkpoint(-100, 3)
+        assert msgmap.get_checkpoints() == {-100: 5}
+        msgmap.set_checkpoint(-100, 4)
+        msgmap.set_checkpoint(-200, 1)
+        msgmap.close()
+
+        msgmap = MessageMap(path, flush_interval=60)
+        assert msgmap.get_checkpoints() == {-100: 5, -200: 1}
+        # checkpoints are saved in batches, with the pending mappings
+        msgmap.add(-100, 6, 10, 106)
+        msgmap.set_checkpoint(-100, 6)
+        other = MessageMap(path)
+        assert other.get_checkpoints() == {-100: 5, -200: 1}
+        msgmap.flush()
+        assert other.get_checkpoints() == {-100: 6, -200: 1}
+        assert other.get_dcmsgs(-100, 6) == {10: 106}
+        other.close()
+        msgmap.close()
+
+    def test_evict(self, tmp_path) -> None:
+        msgmap = MessageMap(str(tmp_path / "msgmap.db"), max_rows=2)
+        for msgid in range(5):
+            msgmap.add(-100, msgid, 10, msgid + 100)
+        msgmap.evict()
+        assert msgmap.get_dcmsgs(-100, 0) == {}
+        assert msgmap.get_dcmsgs(-100, 4) == {10: 104}
+
+        msgmap.max_age = -1
+        msgmap.evict()
+        assert msgmap.get_dcmsgs(-100, 4) == {}
+
+    def test_legacy_cache(self, tmp_path) -> None:
+        legacy_dir = str(tmp_path / "cache")
+        cache = FileSystemCache(legacy_dir, threshold=0)
+        cache.set("d-100/101", 1)
+        cache.set("t-100/1", 101)
+
+        msgmap = MessageMap(str(tmp_path / "msgmap.db"), legacy_dir=legacy_dir)
+        assert msgmap.get_tgmsg(-100, 101) == 1
+        assert msgmap.get_dcmsg(-100, 1, 10) == 101
+        assert msgmap.get_dcmsgs(-100, 1) == {UNKNOWN_CHAT: 101}
+
+        msgmap.max_age = -1
+        msgmap.evict()
+        assert not os.path.exists(legacy_dir)
+        assert msgmap.get_tgmsg(-100, 101) is None  # expired
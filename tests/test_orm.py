@@ -0,0 +1,63 @@
+import asyncio
+import sqlite3
+
+from simplebot_tggroups.orm import Link, init, links, session_scope
+from simplebot_tggroups.routing import RoutingTable, routes
+
+
+class TestRoutingTable:
+    def test_add_remove(self) -> None:
+        table = RoutingTable()
+        table.load([(1, -10), (2, -10)])
+        table.add(3, -30)
+        assert table.get_dcchats(-10) == {1, 2}
+        assert table.get_tgchats(3) == {-30}
+        assert len(table) == 3
+
+        table.remove(1, -10)
+        table.remove(3, -30)
+        assert table.get_dcchats(-10) == {2}
+        assert not table.get_tgchats(1)
+        assert not table.get_dcchats(-30)
+        assert len(table) == 1
+
+    def test_peers(self) -> None:
+        table = RoutingTable()
+        table.load([(1, -10), (2, -10), (2, -20), (1, -20), (3, -20), (4, -40)])
+        assert table.get_dc_peers(1) == {2: -20, 3: -20}
+        assert table.get_dc_peers(3) == {1: -20, 2: -20}
+        assert table.get_tg_peers(-10) == {-20: 1}
+        assert not table.get_dc_peers(4)
+        assert not table.get_tg_peers(-40)
+
+
+def test_migrate(tmp_path) -> None:
+    path = tmp_path / "sqlite.db"
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE link (dcchat INTEGER PRIMARY KEY, tgchat INTEGER)")
+        conn.execute("CREATE INDEX ix_link_tgchat ON link (tgchat)")
+        conn.executemany("INSERT INTO link VALUES (?, ?)", [(1, -10), (2, None)])
+    conn.close()
+
+    init(f"sqlite:///{path}")
+    assert routes.get_tgchats(1) == {-10}
+    with session_scope() as session:
+        session.add(Link(dcchat=1, tgchat=-20))
+    with session_scope() as session:
+        links = {(link.dcchat, link.tgchat) for link in session.query(Link)}
+    assert links == {(1, -10), (1, -20)}
+
+
+def test_link_repository(tmp_path) -> None:
+    init(f"sqlite:///{tmp_path / 'sqlite.db'}")
+    assert links.add(1, -10)
+    assert not links.add(1, -10)
+    assert asyncio.run(links.run(links.add, 1, -20))
+    assert links.add(2, -10)
+    assert routes.get_tgchats(1) == {-10, -20}
+
+    assert links.remove(1, -20) == [-20]
+    assert routes.get_tgchats(1) == {-10}
+    assert sorted(asyncio.run(links.run(links.remove_tgchat, -10))) == [1, 2]
+    assert not routes.get_tgchats(1)
+    assert not links.remove(2)
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+
+from simplebot_tggroups.outbox import Outbox
+
+
+class TestOutbox:
+    def test_spill_and_replay(self, tmp_path) -> None:
+        path = str(tmp_path / "outbox.db")
+        outbox = Outbox()
+        outbox.open(path, memory_limit=2)
+        for msgid in range(5):
+            outbox.put(-100, msgid)
+        assert outbox.qsize() == 2
+
+        async def get(count: int) -> list:
+            return [await asyncio.wait_for(outbox.get(), 5) for _ in range(count)]
+
+        async def done(seqs: list) -> str:
+            # the event loop doesn't wait for the commit
+            await outbox.run(outbox.done, seqs)
+            return (await outbox.run(threading.current_thread)).name
+
+        items = asyncio.run(get(3))
+        assert [msgid for _, _, msgid in items] == [0, 1, 2]
+        assert asyncio.run(done([seq for seq, _, _ in items[:2]])).startswith("db")
+
+        # entries not marked as done are sent again after restart
+        outbox = Outbox()
+        outbox.open(path, memory_limit=2)
+        outbox.put(-100, 5)
+        items = asyncio.run(get(4))
+        assert [msgid for _, _, msgid in items] == [2, 3, 4, 5]
+        assert outbox.replay_until == items[2][0]
+
+        # entries are still loaded from disk without memory limit
+        outbox = Outbox()
+        outbox.open(path, memory_limit=0)
+        items = asyncio.run(get(4))
+        assert [msgid for _, _, msgid in items] == [2, 3, 4, 5]
@@ -1,3 +1,51 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+from deltachat.events import FFIEvent
+from telethon import types
+from telethon.errors.rpcerrorlist import BotMethodInvalidError
+
+from simplebot_tggroups.dcside import ContactsListener, dc_names, get_sender_name
+from simplebot_tggroups.routing import routes
+from simplebot_tggroups.tgbot import ALBUM_MAX_SIZE, ALBUM_WINDOW, TelegramBot
+from simplebot_tggroups.util import set_config
+
+
+def _make_tgbot(mocker) -> TelegramBot:
+    set_config(mocker.bot, "api_id", "1")
+    set_config(mocker.bot, "api_hash", "0" * 32)
+    return TelegramBot(mocker.bot)
+
+
+def _make_tgmsg(msgid: int, text: str = "hi", **kwargs) -> SimpleNamespace:
+    """Fake Telegram message, ``data`` is the content of its attachment."""
+    data = kwargs.pop("data", None)
+
+    async def download_media(folder: str) -> str:
+        path = os.path.join(folder, tgmsg.file.name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return path
+
+    tgmsg = SimpleNamespace(
+        id=msgid,
+        text=text,
+        sender=SimpleNamespace(first_name="Bob", last_name=None),
+        sender_id=1,
+        file=data is not None and SimpleNamespace(size=len(data), name="file.bin"),
+        media=None,
+        sticker=None,
+        photo=None,
+        document=None,
+        grouped_id=None,
+        reply_to=None,
+        download_media=download_media,
+    )
+    tgmsg.__dict__.update(kwargs)
+    return tgmsg
+
+
 class TestPlugin:
     """Offline tests"""
 
@@ -8,3 +56,232 @@ class TestPlugin:
     def test_unbridge(self, mocker) -> None:
         msg = mocker.get_one_reply("/unbridge")
         assert "❌" in msg.text
+
+    def test_unbridge_invalid_id(self, mocker) -> None:
+        msg = mocker.get_one_reply("/unbridge abc", group="group")
+        assert "❌" in msg.text
+
+    def test_media(self, mocker) -> None:
+        msg = mocker.get_one_reply("/media 1280 75 0", group="group")
+        assert "1280px, quality 75" in msg.text
+        assert "Videos: original" in msg.text
+
+        msg = mocker.get_one_reply("/media 1280", group="group")
+        assert "❌" in msg.text
+
+        msg = mocker.get_one_reply("/media default", group="group")
+        assert "Images: original size" in msg.text
+
+    def test_send_to_dc_peers(self, mocker) -> None:
+        set_config(mocker.bot, "api_id", "1")
+        set_config(mocker.bot, "api_hash", "0" * 32)
+        chats = [mocker.account.create_group_chat(f"group {i}") for i in range(3)]
+        for chat in chats[:2]:
+            routes.add(chat.id, -10)
+        tgbot = TelegramBot(mocker.bot)
+        msg = mocker.make_incoming_message(text="hello", group=chats[0])
+
+        tgbot._send_to_dc_peers(-10, 5, [tgbot.dc.get_message(msg.id)])
+        copy = chats[1].get_messages()[-1]
+        assert copy.text == "hello"
+        assert tgbot.msgmap.get_dcmsg(-10, 5, chats[1].id) == copy.id
+        assert all(msg.is_system_message() for msg in chats[2].get_messages())
+
+    def test_dc_names_cache(self, mocker) -> None:
+        msg = mocker.make_incoming_message(text="hi", group="group")
+        contact_id = msg.get_sender_contact().id
+        name = get_sender_name(msg)
+        assert dc_names.get(contact_id) == name
+
+        event = FFIEvent("DC_EVENT_CONTACTS_CHANGED", contact_id, 0)
+        ContactsListener().ac_process_ffi_event(event)
+        assert dc_names.get(contact_id) is None
+
+    def test_edit_and_delete(self, mocker) -> None:
+        set_config(mocker.bot, "api_id", "1")
+        set_config(mocker.bot, "api_hash", "0" * 32)
+        chat = mocker.account.create_group_chat("group")
+        routes.add(chat.id, -20)
+        tgbot = TelegramBot(mocker.bot)
+        tgbot._send_to_dc(-20, [(5, None, dict(text="helo", sender="Bob"))])
+        copy = chat.get_messages()[-1]
+
+        sender = SimpleNamespace(first_name="Bob", last_name=None)
+        tgmsg = SimpleNamespace(id=5, text="hello", sender=sender, sender_id=1)
+        asyncio.run(tgbot._edit_tgmsg(-20, tgmsg))
+        edit = chat.get_messages()[-1]
+        assert edit.text == "✏️ hello"
+        assert edit.quote.id == copy.id
+
+        async def delete() -> None:
+            # queued deletions are merged
+            tgbot.tg2dc_dispatcher.submit(-20, (tgbot._delete_tgmsgs, [5]))
+            await tgbot._delete_tgmsgs(-20, [6])
+            assert not tgbot.tg2dc_dispatcher.qsize()
+
+        asyncio.run(delete())
+        assert copy.id not in [msg.id for msg in chat.get_messages()]
+
+    def test_backfill(self, mocker) -> None:
+        set_config(mocker.bot, "api_id", "1")
+        set_config(mocker.bot, "api_hash", "0" * 32)
+        routes.add(mocker.account.create_group_chat("group").id, -30)
+        tgbot = TelegramBot(mocker.bot)
+        tgbot.msgmap.set_checkpoint(-30, 10)
+        tgbot.msgmap.add(-30, 12, 1, 1)  # relayed before the restart
+
+        def make_message(msgid: int, **kwargs) -> types.Message:
+            tgmsg = types.Message(msgid, None, None, "hi", **kwargs)
+            tgmsg._finish_init(tgbot, {}, None)
+            return tgmsg
+
+        history = {msgid: make_message(msgid) for msgid in (11, 12, 14)}
+        history[13] = make_message(13, out=True)
+
+        async def iter_messages(*args, **kwargs):
+            raise BotMethodInvalidError(None)
+            yield  # pylint: disable=W0101
+
+        async def get_messages(tgchat, ids):
+            assert tgchat == -30
+            return [history.get(msgid) for msgid in ids]
+
+        received = []
+        tgbot.iter_messages = iter_messages
+        tgbot.get_messages = get_messages
+        tgbot._receive = lambda tgchat, tgmsg: received.append(tgmsg.id)
+        tgbot.tg2dc_dispatcher.submit = lambda tgchat, item: received.append(item)
+        # live messages, edits and deletions that arrived during the backfill
+        tgbot._backfilling = {-30: [history[14], make_message(15)]}
+        edited = make_message(15, edit_date=1)
+        asyncio.run(tgbot.tg_edit(SimpleNamespace(chat_id=-30, message=edited)))
+        asyncio.run(tgbot.tg_delete(SimpleNamespace(chat_id=-30, deleted_ids=[11])))
+
+        asyncio.run(tgbot.backfill())
+        assert received == [
+            11,
+            14,
+            15,
+            (tgbot._edit_tgmsg, edited),
+            (tgbot._delete_tgmsgs, [11]),
+        ]
+        assert not tgbot._backfilling
+
+    def test_tg2dc(self, mocker) -> None:
+        chat = mocker.account.create_group_chat("group")
+        routes.add(chat.id, -40)
+        tgbot = _make_tgbot(mocker)
+
+        tgmsg = _make_tgmsg(1, data=b"data")
+        asyncio.run(tgbot._tg2dc(-40, [tgmsg, _make_tgmsg(2, text="")]))
+        msg = chat.get_messages()[-1]
+        assert msg.text == "hi"
+        assert msg.override_sender_name == "Bob"
+        with open(msg.filename, "rb") as file:
+            assert file.read() == b"data"
+        assert tgbot.msgmap.get_dcmsg(-40, 1, chat.id) == msg.id
+        assert tgbot.msgmap.get_dcmsg(-40, 2, chat.id) is None  # empty message
+
+    def test_tg2dc_unknown_size(self, mocker, tmp_path) -> None:
+        chat = mocker.account.create_group_chat("group")
+        routes.add(chat.id, -41)
+        tgbot = _make_tgbot(mocker)
+        set_config(mocker.bot, "max_size", "10")
+
+        async def iter_download(media, offset=0, request_size=0):
+            for _ in range(5):
+                yield b"12345"
+
+        tgbot.iter_download = iter_download
+        tgmsg = _make_tgmsg(1, text="caption", data=b"")
+        tgmsg.file.size = None
+        asyncio.run(tgbot._tg2dc(-41, [tgmsg]))
+        msg = chat.get_messages()[-1]
+        assert msg.text == "caption"
+        assert not msg.filename  # download aborted when exceeding max_size
+
+        # names given by the sender can't escape the download folder
+        async def iter_download_small(media, offset=0, request_size=0):
+            yield b"12345"
+
+        tgbot.iter_download = iter_download_small
+        tgmsg = _make_tgmsg(2, data=b"")
+        tgmsg.file.size = None
+        tgmsg.file.name = "../../evil.bin"
+        path = asyncio.run(tgbot._download_media(tgmsg, str(tmp_path)))
+        assert path == str(tmp_path / "evil.bin")
+
+    def test_albums(self, mocker) -> None:
+        routes.add(mocker.account.create_group_chat("group").id, -42)
+        tgbot = _make_tgbot(mocker)
+        batches = []
+
+        async def tg2dc(tgchat: int, tgmsgs: list) -> None:
+            batches.append([tgmsg.id for tgmsg in tgmsgs])
+
+        tgbot._tg2dc = tg2dc
+
+        async def receive(*tgmsgs) -> None:
+            for tgmsg in tgmsgs:
+                await tgbot.tg2dc(SimpleNamespace(message=tgmsg, chat_id=-42))
+            await asyncio.sleep(0.01)
+
+        async def run() -> None:
+            # items are collected until the window expires
+            await receive(_make_tgmsg(1, grouped_id=7), _make_tgmsg(2, grouped_id=7))
+            assert not batches
+            await asyncio.sleep(ALBUM_WINDOW + 0.1)
+            assert batches == [[1, 2]]
+
+            # a message out of the album flushes it
+            await receive(_make_tgmsg(3, grouped_id=8), _make_tgmsg(4))
+            assert batches[1:] == [[3], [4]]
+
+            # full albums are flushed without waiting
+            album = [_make_tgmsg(msgid, grouped_id=9) for msgid in range(5, 15)]
+            await receive(*album)
+            assert batches[3:] == [list(range(5, 5 + ALBUM_MAX_SIZE))]
+
+        asyncio.run(run())
+
+    def test_album_mapping(self, mocker) -> None:
+        chat = mocker.account.create_group_chat("group")
+        routes.add(chat.id, -43)
+        tgbot = _make_tgbot(mocker)
+
+        album = [_make_tgmsg(msgid, grouped_id=7) for msgid in (1, 2)]
+        asyncio.run(tgbot._tg2dc(-43, album))
+        copies = chat.get_messages()[-2:]
+        assert [tgbot.msgmap.get_dcmsg(-43, msgid, chat.id) for msgid in (1, 2)] == [
+            msg.id for msg in copies
+        ]
+
+    def test_coalesce(self, mocker) -> None:
+        chat = mocker.account.create_group_chat("group")
+        tgbot = _make_tgbot(mocker)
+        tgbot.coalesce_size = 100
+        texts = ("one", "two", "three", "x" * 100)
+        msgids = [chat.send_text(text).id for text in texts]
+        merged: list = []
+        separate: list = []
+
+        async def handler(tgchat: int, item: tuple) -> None:
+            seq, msgid = item
+            if seq:
+                separate.append(seq)
+                return
+            seqs = [seq]
+            text = await tgbot._coalesce(tgchat, texts[0], [], seqs)
+            merged.append((text.count("\n"), seqs))
+
+        async def run() -> None:
+            tgbot.dc2tg_dispatcher.handler = handler
+            for seq, msgid in enumerate(msgids):
+                tgbot.dc2tg_dispatcher.submit(-50, (seq, msgid))
+            while tgbot.dc2tg_dispatcher.depths():
+                await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        # queued messages are merged until the maximum length is reached
+        assert merged == [(2, [0, 1, 2])]
+        assert separate == [3]
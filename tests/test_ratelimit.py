@@ -0,0 +1,48 @@
+import asyncio
+import logging
+import time
+
+import pytest
+from telethon.errors import FloodWaitError
+
+from simplebot_tggroups.ratelimit import SendScheduler, TokenBucket
+
+
+class TestTokenBucket:
+    def test_reserve(self) -> None:
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+        assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+    def test_pause(self) -> None:
+        bucket = TokenBucket(rate=10, capacity=2)
+        bucket.pause(1)
+        assert bucket.reserve() == pytest.approx(1.1, abs=0.01)
+
+
+class TestSendScheduler:
+    def test_flood_wait(self) -> None:
+        scheduler = SendScheduler(logging.getLogger(__name__), chat_rate=100)
+        calls = []
+
+        async def request() -> str:
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                raise FloodWaitError(None, capture=0)
+            return "sent"
+
+        assert asyncio.run(scheduler.send(1, request)) == "sent"
+        assert len(calls) == 2
+
+    def test_max_retries(self) -> None:
+        scheduler = SendScheduler(
+            logging.getLogger(__name__), chat_rate=100, max_retries=1
+        )
+
+        async def request() -> None:
+            raise FloodWaitError(None, capture=0)
+
+        with pytest.raises(FloodWaitError):
+            asyncio.run(scheduler.send(1, request))
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+
+import pytest
+from telethon import types
+
+from simplebot_tggroups import streaming
+from simplebot_tggroups.streaming import CHUNK_SIZE, download, upload
+
+
+class FakeClient:
+    def __init__(self, data: bytes = b"") -> None:
+        self.data = data
+        self.failures = 1
+        self.parts: dict = {}
+
+    async def iter_download(self, media, offset: int = 0, request_size: int = 0):
+        for start in range(offset, len(self.data), request_size):
+            if start > offset and self.failures:
+                self.failures -= 1
+                raise ConnectionError("connection lost")
+            yield self.data[start : start + request_size]
+
+    async def __call__(self, request) -> bool:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("connection lost")
+        self.parts[request.file_part] = request.bytes
+        return True
+
+
+def test_download_resumes(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(asyncio, "sleep", _no_sleep)
+    data = os.urandom(CHUNK_SIZE * 3 + 10)
+    path = str(tmp_path / "file")
+    logger = logging.getLogger()
+
+    assert asyncio.run(download(FakeClient(data), None, path, len(data), logger))
+    with open(path, "rb") as file:
+        assert file.read() == data
+
+    assert not asyncio.run(download(FakeClient(data), None, path, CHUNK_SIZE, logger))
+    assert not os.path.exists(path)
+
+    # partial files are removed when the download fails
+    with pytest.raises(ConnectionError):
+        asyncio.run(download(FakeClient(data), None, path, len(data), logger, 0))
+    assert not os.path.exists(path)
+
+
+def test_upload_resumes(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(asyncio, "sleep", _no_sleep)
+    monkeypatch.setattr(streaming, "BIG_FILE_SIZE", CHUNK_SIZE)
+    data = os.urandom(CHUNK_SIZE * 2 + 10)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    client = FakeClient()
+
+    input_file = asyncio.run(upload(client, str(path), logging.getLogger()))
+    assert isinstance(input_file, types.InputFileBig)
+    assert input_file.parts == 3
+    assert input_file.name == "file.bin"
+    assert b"".join(client.parts[part] for part in range(3)) == data
+
+
+async def _no_sleep(delay) -> None:
+    pass
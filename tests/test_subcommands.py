@@ -0,0 +1,19 @@
+import pytest
+
+from simplebot_tggroups.subcommands import _check_tweak
+
+
+def test_check_tweak() -> None:
+    for key, value in (("queue_size", "1"), ("chat_rate", "0.5"), ("max_size", "x")):
+        _check_tweak(key, value)
+    for key, value in (
+        ("queue_size", "0"),
+        ("max_workers", "0"),
+        ("max_downloads", "0"),
+        ("queue_size", "1.5"),
+        ("global_rate", "0"),
+        ("chat_rate", "nan"),
+        ("image_quality", "96"),
+    ):
+        with pytest.raises(ValueError):
+            _check_tweak(key, value)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import queue
+import threading
+
+import pytest
+
+from simplebot_tggroups.util import (
+    AsyncQueue,
+    ChatDispatcher,
+    MediaLimits,
+    TTLCache,
+    get_media_limits,
+    idle,
+    set_config,
+)
+
+
+class TestAsyncQueue:
+    def test_thread_to_loop(self) -> None:
+        q = AsyncQueue()
+
+        async def consume() -> list:
+            threading.Thread(target=lambda: [q.put(i) for i in range(100)]).start()
+            return [await asyncio.wait_for(q.aget(), 5) for _ in range(100)]
+
+        assert asyncio.run(consume()) == list(range(100))
+
+    def test_bounded(self) -> None:
+        q = AsyncQueue(maxsize=1)
+        q.put(1)
+        with pytest.raises(queue.Full):
+            q.put_nowait(2)
+        with pytest.raises(queue.Full):
+            q.put(2, timeout=0.01)
+
+        async def consume() -> list:
+            putter = asyncio.ensure_future(q.aput(2))
+            await asyncio.sleep(0.01)
+            assert not putter.done()
+            items = [await q.aget(), await q.aget()]
+            await putter
+            return items
+
+        assert asyncio.run(consume()) == [1, 2]
+        assert q.empty()
+
+    def test_cancelled_getter(self) -> None:
+        q = AsyncQueue()
+
+        async def consume() -> None:
+            getter = asyncio.ensure_future(q.aget())
+            await asyncio.sleep(0)
+            getter.cancel()
+            q.put(1)
+            assert await asyncio.wait_for(q.aget(), 5) == 1
+
+        asyncio.run(consume())
+
+
+class TestChatDispatcher:
+    def test_order_and_concurrency(self) -> None:
+        handled: list = []
+        logger = logging.getLogger(__name__)
+
+        async def handler(chat_id: int, item: int) -> None:
+            if chat_id == 1:
+                await asyncio.sleep(0.05)  # slow chat
+            handled.append((chat_id, item))
+            if item == 1:
+                raise ValueError("errors must not stop the lane")
+
+        async def dispatch() -> None:
+            dispatcher = ChatDispatcher(handler, 2, logger)
+            for item in range(3):
+                dispatcher.submit(1, item)
+                dispatcher.submit(2, item)
+            assert dispatcher.depths() == {1: 3, 2: 3}
+            assert dispatcher.qsize() == 6
+            # the metrics read the depths from their own threads
+            depths = await asyncio.get_running_loop().run_in_executor(
+                None, dispatcher.depths
+            )
+            assert sum(depths.values()) <= 6
+            while dispatcher.depths():
+                await asyncio.sleep(0.01)
+
+        asyncio.run(dispatch())
+        assert [item for chat, item in handled if chat == 1] == [0, 1, 2]
+        assert [item for chat, item in handled if chat == 2] == [0, 1, 2]
+        assert handled[:3] == [(2, 0), (2, 1), (2, 2)]
+
+    def test_take(self) -> None:
+        async def handler(chat_id: int, item: int) -> None:
+            pass
+
+        async def dispatch() -> list:
+            dispatcher = ChatDispatcher(handler, 1, logging.getLogger(__name__))
+            for item in (1, 2, 3, 10, 4):
+                dispatcher.submit(1, item)
+            taken = dispatcher.take(1, lambda item: item < 10)
+            assert dispatcher.depths() == {1: 2}
+            assert dispatcher.qsize() == 2
+            return taken
+
+        assert asyncio.run(dispatch()) == [1, 2, 3]
+
+    def test_wait_for_room(self) -> None:
+        async def handler(chat_id: int, item: int) -> None:
+            await asyncio.sleep(0.01)
+
+        async def dispatch() -> None:
+            dispatcher = ChatDispatcher(
+                handler, 1, logging.getLogger(__name__), maxsize=2
+            )
+            for item in range(3):
+                await asyncio.wait_for(dispatcher.wait_for_room(), 5)
+                dispatcher.submit(1, item)
+            waiter = asyncio.ensure_future(dispatcher.wait_for_room())
+            await asyncio.sleep(0)
+            assert not waiter.done()  # two items waiting, the first one handled
+            await asyncio.wait_for(waiter, 5)
+            assert dispatcher.qsize() < 2
+
+        asyncio.run(dispatch())
+
+    def test_idle(self) -> None:
+        handled: list = []
+
+        async def handler(chat_id: int, item: int) -> None:
+            if chat_id == 1:
+                # waiting chats don't hold the only worker
+                await asyncio.gather(*(asyncio.sleep(0.05) for _ in range(2)))
+                async with idle():
+                    await asyncio.gather(*(idle_sleep() for _ in range(2)))
+            handled.append(chat_id)
+
+        async def idle_sleep() -> None:
+            async with idle():
+                await asyncio.sleep(0.05)
+
+        async def dispatch() -> None:
+            dispatcher = ChatDispatcher(handler, 1, logging.getLogger(__name__))
+            dispatcher.submit(1, 0)
+            await asyncio.sleep(0.06)
+            dispatcher.submit(2, 0)
+            dispatcher.submit(1, 1)
+            while dispatcher.depths():
+                await asyncio.sleep(0.01)
+            assert dispatcher._semaphore._value == 1  # slot given back once
+
+        asyncio.run(dispatch())
+        assert handled == [2, 1, 1]
+
+
+class TestTTLCache:
+    def test_lru(self) -> None:
+        cache = TTLCache(2, 60)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        assert cache.get(1) == "a"
+        cache.set(3, "c")
+        assert cache.get(2) is None
+        assert cache.get(1) == "a"
+        cache.pop(1)
+        assert cache.get(1) is None
+        assert len(cache) == 1
+
+    def test_expiration(self) -> None:
+        cache = TTLCache(2, 0)
+        cache.set(1, "a")
+        assert cache.get(1, "default") == "default"
+        assert not cache
+
+
+class TestMediaLimits:
+    def test_parse(self) -> None:
+        limits = MediaLimits.parse(" 1280 75  500 ")
+        assert limits == MediaLimits(1280, 75, 500)
+        assert MediaLimits.parse(str(limits)) == limits
+        for text in ("1280 75", "1280 0 500", "-1 75 0", "a b c"):
+            with pytest.raises(ValueError):
+                MediaLimits.parse(text)
+
+    def test_get_media_limits(self, mocker) -> None:
+        set_config(mocker.bot, "image_size", "1280")
+        set_config(mocker.bot, "image_quality", "100")
+        set_config(mocker.bot, "video_bitrate", "0")
+        # invalid defaults disable the limits instead of failing
+        assert get_media_limits(mocker.bot, 10) == MediaLimits(0, 85, 0)
+
+        set_config(mocker.bot, "media_limits_10", "640 70 300")
+        assert get_media_limits(mocker.bot, 10) == MediaLimits(640, 70, 300)
+        # limits are cached until the settings change with set_config()
+        mocker.bot.set("media_limits_10", "640", scope="simplebot_tggroups")
+        assert get_media_limits(mocker.bot, 10) == MediaLimits(640, 70, 300)
+
+        # invalid limits of the chat fall back to the default ones
+        set_config(mocker.bot, "image_quality", "80")
+        assert get_media_limits(mocker.bot, 10) == MediaLimits(1280, 80, 0)